@@ -1,72 +1,616 @@
-import trio, httpx
 import json
-from datetime import datetime, timedelta
-from dateutil import tz
-from prettytable import PrettyTable
-from bs4 import BeautifulSoup
+import argparse
+import importlib.util
+import os, sys, io, math, functools, time, random, threading, contextlib, statistics, collections
+import concurrent.futures
+import http, http.server, urllib.parse, hashlib, gzip, heapq, csv, bisect
+from datetime import datetime, timedelta, timezone
+
+def lazy_import(name):
+    # The module is only loaded on first attribute access, so one-shot runs
+    # that never fetch or draw a table don't pay for importing it.
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+trio = lazy_import("trio")
+httpx = lazy_import("httpx")
+prettytable = lazy_import("prettytable")
+np = lazy_import("numpy")
 
 bit2me_currencies = ["BTC", "BCH", "ETH", "LTC", "DASH", "XRP", "ADA", "LINK", "COMP", "ATOM", "DAI", "XMR", "OMG", "DOT", "SC", "XLM", "USDT", "USDC", "ZEC", "XTZ", "UNI"]
 COL_WIDTH = 9
 DIVIDER_STRING = "-"*(COL_WIDTH)
 
-def get_bit2me_endpoint():
+# Connection pool used by the long-lived session (see run_session).
+HTTP_MAX_CONNECTIONS = 10
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 300 # seconds
+
+# Seconds each exchange gets to answer, and for the whole fetch. Exchanges
+# that miss their deadline are shown with their last answer (marked stale, if
+# it is younger than STALE_MAX_AGE) or as missing.
+DEFAULT_DEADLINE = 5
+EXCHANGE_DEADLINES = {
+    "sat. t.": 4
+}
+LATENCY_BUDGET = 6
+STALE_MAX_AGE = 600
+
+# See fetch_with_retries.
+FETCH_MAX_CONCURRENCY = 16
+DEFAULT_HOST_RATE = 2
+DEFAULT_HOST_BURST = 4
+HOST_RATE_LIMITS = {
+    # "api.example.com": (requests per second, burst), or None for no limit
+}
+FETCH_RETRIES = 2
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 4
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+HEDGE_MIN_SAMPLES = 10 # latencies seen before an exchange is hedged
+HEDGE_LATENCY_WINDOW = 200 # latencies kept per exchange
+HEDGE_MAX_RATIO = 0.1 # hedges allowed per request sent
+HEDGE_BURST = 3
+
+# Fiat (or stablecoin) spent on bit2me and received on the exchanges; see
+# CONFIG["base"] and CONFIG["quote"]. MARKET_CURRENCIES are the quote
+# currencies recognised at the end of market names such as buenbit's "btcars".
+BASE_CURRENCY = "EUR"
+QUOTE_CURRENCY = "ARS"
+MARKET_CURRENCIES = ["ARS", "USDT", "USDC", "USD", "DAI", "EUR", "BRL", "BTC"]
+
+# Set from the command line in main().
+CONFIG = {
+    "record_dir": None, # save every raw response set here (see save_snapshot)
+    "endpoints": None, # overrides get_all_endpoints(), e.g. the replay server
+    "deadlines": EXCHANGE_DEADLINES,
+    "default_deadline": DEFAULT_DEADLINE,
+    "budget": LATENCY_BUDGET,
+    "progressive": False, # fill the table in as each exchange answers
+    "store_dir": None, # append every processed snapshot here (see append_to_store)
+    "json_backend": "auto", # see get_json_loader
+    "metrics_log": None, # JSON lines file, one line per check
+    "metrics_prom": None, # Prometheus text file with the last check
+    "profile": False, # print the timings of every check
+    "max_concurrency": FETCH_MAX_CONCURRENCY, # see fetch_with_retries
+    "host_rate": DEFAULT_HOST_RATE,
+    "host_burst": DEFAULT_HOST_BURST,
+    "retries": FETCH_RETRIES,
+    "depth": False, # price sells against order books where available (see add_depth_books)
+    "output": "table", # or one of RECORD_FORMATS, see write_rate_records
+    "hedge": None, # latency percentile after which a second request is sent (see fetch_hedged)
+    "hedge_ratio": HEDGE_MAX_RATIO,
+    "alert_sink": ("stderr", None), # (sink name, target), see ALERT_SINKS
+    "base": BASE_CURRENCY,
+    "quote": QUOTE_CURRENCY,
+    "warm_start": None # file with the last processed rates (see save_warm_start)
+}
+
+# Last fresh answer per exchange: {exchange: (raw response, datetime)}
+last_responses = {}
+
+# Recent latencies (seconds) of the successful requests to every exchange,
+# and the tokens left for hedged requests (see fetch_hedged).
+exchange_latencies = {}
+hedge_budget = {"tokens": HEDGE_BURST}
+
+# Validators of the last 200 answer per exchange, for conditional requests:
+# {exchange: {"url": ..., "etag": ..., "last_modified": ..., "body": raw}}
+http_validators = {}
+
+# Polling interval (seconds) per exchange in --watch mode.
+WATCH_DEFAULT_INTERVAL = 60
+WATCH_INTERVALS = {
+    "bit2me_new": 30
+}
+
+# BIT2ME_COMMISSION = 0.03 # bit2me old
+BIT2ME_COMMISSION = 0.025 # bit2me new
+
+# Currencies bit2me sells, discovered from its catalog and cached on disk for
+# BIT2ME_CATALOG_TTL seconds. bit2me_currencies is used until the first
+# discovery succeeds.
+BIT2ME_CATALOG_URL = "https://gateway.bit2me.com/v2/currency/assets/details"
+BIT2ME_CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bit2me_currencies.json")
+BIT2ME_CATALOG_TTL = 24*3600
+BIT2ME_CATALOG_RETRY = 300 # seconds before retrying a failed discovery
+BIT2ME_MAX_URL_LENGTH = 2000
+bit2me_catalog = {"currencies": None, "timestamp": 0}
+
+def process_bit2me_catalog(raw):
+    catalog = load_json(raw)
+    if isinstance(catalog, dict):
+        catalog = list(catalog)
+    currencies = []
+    for item in catalog:
+        if isinstance(item, dict):
+            if item.get("type") == "fiat":
+                continue
+            item = item.get("symbol")
+        if item and item.upper() != CONFIG["base"] and item.upper() not in currencies:
+            currencies.append(item.upper())
+    return currencies
+
+def load_bit2me_catalog(catalog_file=BIT2ME_CATALOG_FILE):
+    if bit2me_catalog["currencies"] is None and os.path.exists(catalog_file):
+        try:
+            with open(catalog_file, encoding="utf-8") as f:
+                cached = json.load(f)
+            currencies, timestamp = list(cached["currencies"]), float(cached["timestamp"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # A bad cache is refetched; until then the built-in list is used.
+            print("Ignoring the bit2me catalog in " + catalog_file + ": " + str(e), file=sys.stderr)
+        else:
+            bit2me_catalog["currencies"] = currencies
+            bit2me_catalog["timestamp"] = timestamp
+    return bit2me_catalog["currencies"] or bit2me_currencies
+
+async def update_bit2me_catalog(error_log, client=None, catalog_file=BIT2ME_CATALOG_FILE):
+    load_bit2me_catalog(catalog_file)
+    now = time.time()
+    if now - bit2me_catalog["timestamp"] < BIT2ME_CATALOG_TTL:
+        return
+    catalog_res = await run_requests({"bit2me catalog": BIT2ME_CATALOG_URL}, error_log, client, CONFIG["deadlines"], CONFIG["budget"], default_deadline=CONFIG["default_deadline"])
+    try:
+        currencies = process_bit2me_catalog(catalog_res["bit2me catalog"])
+        if len(currencies) == 0:
+            raise ValueError("empty catalog")
+    except Exception as e:
+        if has_key(catalog_res, "bit2me catalog"):
+            error_log.append("Error while reading the bit2me catalog: " + str(e))
+        # Keep the currencies we have and try again later.
+        bit2me_catalog["timestamp"] = now - BIT2ME_CATALOG_TTL + BIT2ME_CATALOG_RETRY
+        return
+    bit2me_catalog["currencies"] = currencies
+    bit2me_catalog["timestamp"] = now
+    # Written whole and renamed, so a crash never leaves half a file.
+    with open(catalog_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"timestamp": now, "currencies": currencies}, f)
+    os.replace(catalog_file + ".tmp", catalog_file)
+
+def get_bit2me_convert_url(currencies, timestamp):
     # https://gateway.bit2me.com/v1/currency/convert?
-    #   from=BTC,BCH,ETH,LTC,DASH,XRP,ADA,LINK,COMP,ATOM,DAI,XMR,OMG,DOT,SC,XLM,USDT,USDC,ZEC,XTZ,UNI
-    #   &to=EUR
-    #   &value=1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1
-    #   &time=2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z
-    bit2me_endpoint = "https://gateway.bit2me.com/v1/currency/convert?"
-    
-    bit2me_endpoint += "from="
-    for currency in bit2me_currencies:
-        bit2me_endpoint += currency + ","
-    bit2me_endpoint = bit2me_endpoint[:-1]
-    
-    bit2me_endpoint += "&to=EUR"
+    #   from=BTC,BCH,ETH,...
+    #   &to=EUR (CONFIG["base"])
+    #   &value=1,1,1,...
+    #   &time=2020-11-03T22:54:00.000Z,2020-11-03T22:54:00.000Z,...
+    return "https://gateway.bit2me.com/v1/currency/convert?" + urllib.parse.urlencode({
+        "from": ",".join(currencies),
+        "to": CONFIG["base"],
+        "value": ",".join(["1"]*len(currencies)),
+        "time": ",".join([timestamp]*len(currencies))
+    }, safe=",:")
 
-    bit2me_endpoint += "&value="
-    for currency in bit2me_currencies:
-        bit2me_endpoint += "1,"
-    bit2me_endpoint = bit2me_endpoint[:-1]
-    
-    bit2me_endpoint += "&time="
-    timezone_diff = timedelta(hours=3)
-    current_timestamp = datetime.now(tz=None) + timezone_diff
-    current_timestamp = current_timestamp.strftime("%Y-%m-%dT%H:%M:%S.000Z")
-    for currency in bit2me_currencies:
-        bit2me_endpoint += str(current_timestamp) + ","
-    bit2me_endpoint = bit2me_endpoint[:-1]
+def get_bit2me_endpoint():
+    # One request per chunk of currencies, each URL under
+    # BIT2ME_MAX_URL_LENGTH. Chunks are named "bit2me_new:<n>:<currencies>" so
+    # the parser can tell which price belongs to which currency.
+    timestamp = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    endpoints = {}
+    chunk = []
+    for currency in load_bit2me_catalog():
+        if len(chunk) > 0 and len(get_bit2me_convert_url(chunk + [currency], timestamp)) > BIT2ME_MAX_URL_LENGTH:
+            endpoints["bit2me_new:" + str(len(endpoints) + 1) + ":" + ",".join(chunk)] = get_bit2me_convert_url(chunk, timestamp)
+            chunk = []
+        chunk.append(currency)
+    if len(chunk) > 0:
+        endpoints["bit2me_new:" + str(len(endpoints) + 1) + ":" + ",".join(chunk)] = get_bit2me_convert_url(chunk, timestamp)
+    return endpoints
+
+def get_bit2me_chunk_currencies(name):
+    # Snapshots recorded before chunking have a single "bit2me_new" answer.
+    if ":" in name:
+        return name.rsplit(":", 1)[1].split(",")
+    return bit2me_currencies
 
-    return bit2me_endpoint
+def get_endpoint_exchange(name):
+    # Exchanges fetched in several requests name them "<exchange>:<part>".
+    return name.split(":", 1)[0]
+
+def get_endpoint_label(name):
+    # Name shown in messages and metrics: "bit2me_new#2" for the chunk
+    # "bit2me_new:2:<currencies>".
+    parts = name.split(":")
+    if len(parts) == 3:
+        return parts[0] + "#" + parts[1]
+    return name
 
 def get_all_endpoints():
-    return {
-    "bit2me_new": get_bit2me_endpoint(),
-    "ripio": "https://app.ripio.com/api/v3/rates/?country=AR",
-    "sat. t.": "https://api.satoshitango.com/v3/ticker/ARS",
-    "buenbit": "https://be.buenbit.com/api/market/tickers/",
-    # "argenbtc": "https://argenbtc.com/cotizacion",
-    # "argenbtc": "https://argenbtc.com/"
-}
+    endpoints = {}
+    for exchange, adapter in EXCHANGES.items():
+        if adapter["enabled"]:
+            endpoints.update(get_exchange_urls(exchange, adapter))
+    return endpoints
 
-async def run_requests(endpoints, error_log):
+def get_exchange_urls(exchange, adapter):
+    # Endpoints are either fixed URLs or functions building them per request
+    # (e.g. bit2me's carry the current time): one URL, or {name: url} for
+    # exchanges fetched in several requests.
+    url = adapter["endpoint"]() if callable(adapter["endpoint"]) else adapter["endpoint"]
+    if isinstance(url, dict):
+        return url
+    return {exchange: url}
 
-    rates_info = {}
+def get_accept_encoding():
+    # httpx decodes brotli only when the brotli package is installed.
+    if importlib.util.find_spec("brotli") is not None or importlib.util.find_spec("brotlicffi") is not None:
+        return "br, gzip"
+    return "gzip"
 
-    async def get_request(exchange, url, client):
+def get_request_headers(exchange, url):
+    headers = {"Accept-Encoding": get_accept_encoding()}
+    validators = http_validators.get(exchange)
+    if validators is not None and validators["url"] == url:
+        if validators["etag"] is not None:
+            headers["If-None-Match"] = validators["etag"]
+        if validators["last_modified"] is not None:
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def get_response_body(exchange, url, res):
+    # A 304 answer means the body we already have is still current. Returning
+    # that same bytes object lets process_all_info skip parsing it again.
+    if res.status_code == 304 and has_key(http_validators, exchange):
+        return http_validators[exchange]["body"]
+    etag = res.headers.get("ETag")
+    last_modified = res.headers.get("Last-Modified")
+    if etag is not None or last_modified is not None:
+        http_validators[exchange] = {"url": url, "etag": etag, "last_modified": last_modified, "body": res.content}
+    elif has_key(http_validators, exchange):
+        del http_validators[exchange]
+    return res.content
+
+def get_http_client(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY):
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry
+    )
+    try:
+        return httpx.AsyncClient(http2=True, limits=limits)
+    except ImportError:
+        # HTTP/2 needs the optional "h2" package (pip install httpx[http2]).
+        # Keep-alive over HTTP/1.1 still saves the handshakes.
+        return httpx.AsyncClient(limits=limits)
+
+#-------------------------------------------------------------------------------
+# Fetch scheduling. At most FETCH_MAX_CONCURRENCY requests are in flight at
+# once, each host has a token bucket (HOST_RATE_LIMITS, else
+# DEFAULT_HOST_RATE requests per second with bursts of DEFAULT_HOST_BURST),
+# and failed requests (transport errors, 429, 5xx) are retried with jittered
+# exponential backoff, honouring Retry-After. The limiter and the buckets live
+# in trio RunVars, so they are shared by everything in one trio.run.
+
+run_vars = {}
+
+def get_run_var(name, new_value):
+    if has_key(run_vars, name) == False:
+        run_vars[name] = trio.lowlevel.RunVar(name)
+    value = run_vars[name].get(None)
+    if value is None:
+        value = new_value()
+        run_vars[name].set(value)
+    return value
+
+def get_fetch_limiter():
+    return get_run_var("fetch_limiter", lambda: trio.CapacityLimiter(CONFIG["max_concurrency"]))
+
+async def take_host_token(host):
+    limit = HOST_RATE_LIMITS.get(host, (CONFIG["host_rate"], CONFIG["host_burst"]))
+    if limit is None:
+        return
+    rate, burst = limit
+    buckets = get_run_var("host_buckets", dict)
+    if has_key(buckets, host) == False:
+        buckets[host] = {"tokens": burst, "updated": trio.current_time()}
+    bucket = buckets[host]
+    while True:
+        now = trio.current_time()
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"])*rate)
+        bucket["updated"] = now
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return
+        await trio.sleep((1 - bucket["tokens"])/rate)
+
+def get_retry_delay(attempt, res=None):
+    if res is not None and res.headers.get("Retry-After", "").isdigit():
+        return min(float(res.headers["Retry-After"]), RETRY_MAX_DELAY)
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY*2**attempt)*random.uniform(0.5, 1)
+
+async def fetch_with_retries(client, exchange, url):
+
+    # Returns the response of the last attempt, its httpx trace events, the
+    # time it started and the number of attempts. The concurrency slot is
+    # released while waiting to retry.
+
+    host = urllib.parse.urlsplit(url).hostname
+    retries = CONFIG["retries"]
+    for attempt in range(retries + 1):
+        trace_events = {}
+
+        async def trace(event_name, info):
+            trace_events.setdefault(event_name, time.perf_counter())
+
+        try:
+            await take_host_token(host)
+            async with get_fetch_limiter():
+                start = time.perf_counter()
+                res = await client.get(url, headers=get_request_headers(exchange, url), extensions={"trace": trace})
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+            await trio.sleep(get_retry_delay(attempt))
+            continue
+        if res.status_code in RETRY_STATUSES and attempt < retries:
+            await trio.sleep(get_retry_delay(attempt, res))
+            continue
+        return res, trace_events, start, attempt + 1
+
+def add_latency(exchange, latency):
+    exchange = get_endpoint_exchange(exchange)
+    if has_key(exchange_latencies, exchange) == False:
+        exchange_latencies[exchange] = collections.deque(maxlen=HEDGE_LATENCY_WINDOW)
+    exchange_latencies[exchange].append(latency)
+
+def get_latency_percentile(exchange, percentile):
+    # None until HEDGE_MIN_SAMPLES latencies have been seen.
+    latencies = sorted(exchange_latencies.get(get_endpoint_exchange(exchange), []))
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return latencies[min(len(latencies)-1, int(len(latencies)*percentile/100))]
+
+def take_hedge_token():
+    # Every request earns CONFIG["hedge_ratio"] of a hedge, so hedging never
+    # adds more than that fraction of extra requests (plus HEDGE_BURST).
+    if hedge_budget["tokens"] >= 1:
+        hedge_budget["tokens"] -= 1
+        return True
+    return False
+
+async def fetch_hedged(client, exchange, url):
+
+    # fetch_with_retries, plus a second identical request when the first one
+    # hasn't answered within the CONFIG["hedge"] percentile of the exchange's
+    # latency. The first answer wins and the other request is cancelled.
+    # Returns what fetch_with_retries returns and whether a hedge was sent.
+
+    hedge_budget["tokens"] = min(HEDGE_BURST, hedge_budget["tokens"] + CONFIG["hedge_ratio"])
+    delay = get_latency_percentile(exchange, CONFIG["hedge"]) if CONFIG["hedge"] is not None else None
+    answers = []
+    errors = []
+    sent = [0]
+
+    async def fetch(nursery):
+        sent[0] += 1
         try:
-            res = await client.get(url)
-            rates_info[exchange] = res.text
+            answer = await fetch_with_retries(client, exchange, url)
         except Exception as e:
-            error_log.append("Error while getting data from '" + exchange + "': " + str(e))
-    async with httpx.AsyncClient() as client:
-        async with trio.open_nursery() as nursery:
-            for exchange, url in endpoints.items():
-                nursery.start_soon(get_request, exchange, url, client)
+            errors.append(e)
+            if len(errors) == sent[0]:
+                nursery.cancel_scope.cancel()
+            return
+        if answer[0].status_code < 400:
+            # From the start of the last attempt, without the wait for a
+            # slot or the backoff, so the percentile tracks the exchange.
+            add_latency(exchange, time.perf_counter() - answer[2])
+        answers.append(answer)
+        nursery.cancel_scope.cancel()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(fetch, nursery)
+        if delay is not None:
+            await trio.sleep(delay)
+            if take_hedge_token():
+                nursery.start_soon(fetch, nursery)
+
+    if len(answers) == 0:
+        raise errors[-1]
+    return (*answers[0], sent[0] > 1)
+
+async def run_requests(endpoints, error_log, client=None, deadlines=None, budget=None, on_response=None, default_deadline=DEFAULT_DEADLINE, metrics=None):
+
+    # deadlines: {exchange: seconds} (default_deadline for the rest), budget:
+    # seconds for the whole fetch. None means wait forever, as before.
+    # on_response(exchange, raw) is called as soon as each answer arrives.
+    # metrics, when given, gets the timings of every request (see
+    # get_request_metrics). Requests go through fetch_hedged and
+    # fetch_with_retries, so they share the global concurrency cap and the
+    # per-host rate limits.
+
+    rates_info = {}
+    finished = []
+    if metrics is not None:
+        metrics.setdefault("exchanges", {})
+
+    async def get_request(exchange, url, client):
+        deadline = deadlines.get(exchange, deadlines.get(get_endpoint_exchange(exchange), default_deadline)) if deadlines is not None else None
+        with trio.move_on_after(deadline if deadline is not None else math.inf) as cancel_scope:
+            try:
+                res, trace_events, start, attempts, hedged = await fetch_hedged(client, exchange, url)
+                if metrics is not None:
+                    label = get_endpoint_label(exchange)
+                    metrics["exchanges"][label] = get_request_metrics(trace_events, start, time.perf_counter(), res)
+                    metrics["exchanges"][label]["attempts"] = attempts
+                    metrics["exchanges"][label]["hedged"] = hedged
+                if res.status_code != 304:
+                    res.raise_for_status()
+                # Raw bytes: the parsers decode JSON straight from them.
+                rates_info[exchange] = get_response_body(exchange, url, res)
+                if on_response is not None:
+                    on_response(exchange, rates_info[exchange])
+            except Exception as e:
+                error_log.append("Error while getting data from '" + get_endpoint_label(exchange) + "': " + str(e))
+        if cancel_scope.cancelled_caught:
+            error_log.append("No answer from '" + get_endpoint_label(exchange) + "' within " + str(deadline) + "s")
+        finished.append(exchange)
+
+    async def get_all(client):
+        with trio.move_on_after(budget if budget is not None else math.inf):
+            async with trio.open_nursery() as nursery:
+                for exchange, url in endpoints.items():
+                    nursery.start_soon(get_request, exchange, url, client)
+        for exchange in endpoints:
+            if exchange not in finished:
+                error_log.append("No answer from '" + get_endpoint_label(exchange) + "' within the " + str(budget) + "s budget")
+
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            await get_all(client)
+    else:
+        await get_all(client)
 
     return rates_info
 
 
+async def get_requests_res(error_log, client=None, stale=None, missing=None, on_response=None, metrics=None):
+
+    # stale and missing, when given, are filled like error_log:
+    # stale[exchange] = time of the old answer used instead of a fresh one,
+    # missing = exchanges with neither.
+
+    # The bit2me catalog is refreshed alongside the rates, within the same
+    # budget; this fetch uses the currencies known so far.
+    endpoints = CONFIG["endpoints"] if CONFIG["endpoints"] is not None else get_all_endpoints()
+    async with trio.open_nursery() as nursery:
+        if CONFIG["endpoints"] is None and EXCHANGES["bit2me_new"]["enabled"]:
+            nursery.start_soon(update_bit2me_catalog, error_log, client)
+        requests_res = await run_requests(endpoints, error_log, client, CONFIG["deadlines"], CONFIG["budget"], on_response, CONFIG["default_deadline"], metrics)
+    if CONFIG["record_dir"] is not None:
+        save_snapshot(requests_res, CONFIG["record_dir"])
+
+    now = datetime.now(tz=None)
+    for exchange in endpoints:
+        if has_key(requests_res, exchange):
+            last_responses[exchange] = (requests_res[exchange], now)
+        elif has_key(last_responses, exchange) and (now - last_responses[exchange][1]).total_seconds() <= STALE_MAX_AGE:
+            requests_res[exchange] = last_responses[exchange][0]
+            if stale is not None:
+                stale[get_endpoint_label(exchange)] = last_responses[exchange][1]
+        elif missing is not None:
+            missing.append(get_endpoint_label(exchange))
+    return requests_res
+
+#-------------------------------------------------------------------------------
+# Record / replay.
+# A snapshot is a JSON file {"timestamp": ..., "responses": {exchange: raw body}}
+# holding exactly what run_requests returned.
+
+def save_snapshot(requests_res, directory, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz=None)
+    os.makedirs(directory, exist_ok=True)
+    file_path = os.path.join(directory, timestamp.strftime("%Y%m%dT%H%M%S%f") + ".json")
+    with open(file_path, "w", encoding="utf-8") as f:
+        responses = {exchange: raw.decode("utf-8") if isinstance(raw, bytes) else raw for exchange, raw in requests_res.items()}
+        json.dump({"timestamp": timestamp.isoformat(), "responses": responses}, f)
+    return file_path
+
+def load_snapshot(file_path):
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+def get_snapshot_files(directory):
+    return [os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory)) if file_name.endswith(".json")]
+
+def load_snapshots(directory):
+    return [load_snapshot(file_path) for file_path in get_snapshot_files(directory)]
+
+def start_replay_server(snapshots, latency=0, error_rate=0, host="127.0.0.1", port=0):
+
+    # Local stand-in for the exchange APIs. GET /<exchange> answers with the
+    # recorded body for that exchange, cycling through the snapshots. Every
+    # response is delayed by latency seconds (a number, or a dict per exchange)
+    # and error_rate of them fail with a 500 or a dropped connection.
+
+    counters = {}
+    counters_lock = threading.Lock()
+
+    class ReplayHandler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            exchange = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path.lstrip("/"))
+            with counters_lock:
+                count = counters.get(exchange, 0)
+                counters[exchange] = count + 1
+
+            delay = latency.get(exchange, 0) if isinstance(latency, dict) else latency
+            if delay > 0:
+                time.sleep(delay)
+
+            if random.random() < error_rate:
+                if random.random() < 0.5:
+                    self.close_connection = True
+                    return
+                self.send_answer(500, b"injected error")
+                return
+
+            recorded = [snapshot["responses"][exchange] for snapshot in snapshots if has_key(snapshot["responses"], exchange)]
+            if len(recorded) == 0:
+                self.send_answer(404, b"no recording for " + exchange.encode("utf-8"))
+                return
+            body = recorded[count % len(recorded)].encode("utf-8")
+            etag = "\"" + hashlib.sha1(body).hexdigest() + "\""
+            if self.headers.get("If-None-Match") == etag:
+                self.send_answer(304, b"", {"ETag": etag})
+                return
+            headers = {"ETag": etag}
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body)
+                headers["Content-Encoding"] = "gzip"
+            self.send_answer(200, body, headers)
+
+        def send_answer(self, status, body, headers={}):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up waiting (e.g. a deadline ran out).
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    class ReplayServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 128 # the default of 5 drops connections under concurrent benchmarks
+
+    server = ReplayServer((host, port), ReplayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_replay_endpoints(server, exchanges):
+    host, port = server.server_address[:2]
+    return {exchange: "http://" + host + ":" + str(port) + "/" + urllib.parse.quote(exchange) for exchange in exchanges}
+
+def start_replay(directory, latency=0, error_rate=0):
+    snapshots = load_snapshots(directory)
+    exchanges = []
+    for snapshot in snapshots:
+        for exchange in snapshot["responses"]:
+            if exchange not in exchanges:
+                exchanges.append(exchange)
+    server = start_replay_server(snapshots, latency, error_rate)
+    CONFIG["endpoints"] = get_replay_endpoints(server, exchanges)
+    # The stand-in is ours: don't rate-limit it.
+    HOST_RATE_LIMITS[server.server_address[0]] = None
+    return server
+
 def has_key(dict, key):
     try:
         x = dict[key]
@@ -74,115 +618,416 @@ def has_key(dict, key):
     except KeyError:
         return False
 
-def process_info_bit2me(requests_res, rates):
-    bit2me_ticker = json.loads(requests_res["bit2me"])["data"]
-    for item in bit2me_ticker:
-        currency = item["symbol"]
-        if has_key(rates, currency) == False:
-            rates[currency] = {}
-        rates[currency]["buy"] = item["buy"]
-        rates[currency]["network_fee"] = item["network_fee"]
-
-def process_info_bit2me_new(requests_res, rates):
-    bit2me_new_ticker = json.loads(requests_res["bit2me_new"])
-    for i in range(len(bit2me_new_ticker)):
-        currency = bit2me_currencies[i]
-        if has_key(rates, currency) == False:
-            rates[currency] = {}
-        rates[currency]["buy"] = bit2me_new_ticker[i]
-        if has_key(rates[currency], "network_fee") == False:
-            rates[currency]["network_fee"] = 0
-
-def process_info_ripio(requests_res, rates):
+#-------------------------------------------------------------------------------
+# Quote matrix. Parsers fill it and everything downstream reads it. Coins and
+# exchanges are interned to row and column indexes, prices are float64 arrays
+# and presence is kept in boolean masks:
+#   buy[c], network_fee[c]          bit2me price of coin c in CONFIG["base"], has_buy[c]
+#   sell[c, e], commission[c, e]    CONFIG["quote"] price of coin c on exchange e, has_sell[c, e]
+# Arrays are allocated with spare room and doubled when full; get_quote_arrays
+# returns views of the filled part.
+# Every market quote, in whatever currency, is also kept in quotes["pairs"]
+# for the route search and the cross rates (see add_market_quote).
+
+QUOTES_INITIAL_COINS = 32
+QUOTES_INITIAL_EXCHANGES = 8
+
+def new_quotes(n_coins=QUOTES_INITIAL_COINS, n_exchanges=QUOTES_INITIAL_EXCHANGES):
+    return {
+        "coin_index": {},
+        "exchange_index": {},
+        "coins": [],
+        "exchanges": [],
+        "buy": np.full(n_coins, np.nan),
+        "network_fee": np.zeros(n_coins),
+        "has_buy": np.zeros(n_coins, dtype=bool),
+        "sell": np.full((n_coins, n_exchanges), np.nan),
+        "commission": np.zeros((n_coins, n_exchanges)),
+        "has_sell": np.zeros((n_coins, n_exchanges), dtype=bool),
+        "pairs": [],
+        "books": {}
+    }
+
+def grow_quotes(quotes, n_coins, n_exchanges):
+    old_coins, old_exchanges = quotes["sell"].shape
+    grown = new_quotes(n_coins, n_exchanges)
+    for field in ["buy", "network_fee", "has_buy"]:
+        grown[field][:old_coins] = quotes[field]
+        quotes[field] = grown[field]
+    for field in ["sell", "commission", "has_sell"]:
+        grown[field][:old_coins, :old_exchanges] = quotes[field]
+        quotes[field] = grown[field]
+
+def get_coin_index(quotes, coin):
+    c = quotes["coin_index"].get(coin)
+    if c is None:
+        c = len(quotes["coins"])
+        if c == quotes["sell"].shape[0]:
+            grow_quotes(quotes, 2*c, quotes["sell"].shape[1])
+        quotes["coin_index"][coin] = c
+        quotes["coins"].append(coin)
+    return c
+
+def get_exchange_index(quotes, exchange):
+    e = quotes["exchange_index"].get(exchange)
+    if e is None:
+        e = len(quotes["exchanges"])
+        if e == quotes["sell"].shape[1]:
+            grow_quotes(quotes, quotes["sell"].shape[0], 2*e)
+        quotes["exchange_index"][exchange] = e
+        quotes["exchanges"].append(exchange)
+    return e
+
+def set_buy_quote(quotes, coin, price, network_fee=None):
+    # network_fee=None keeps the fee already known for the coin (0 by default).
+    c = get_coin_index(quotes, coin)
+    quotes["buy"][c] = float(price)
+    quotes["has_buy"][c] = True
+    if network_fee is not None:
+        quotes["network_fee"][c] = float(network_fee)
+
+def set_sell_quote(quotes, coin, exchange, price, commission):
+    c = get_coin_index(quotes, coin)
+    e = get_exchange_index(quotes, exchange)
+    quotes["sell"][c, e] = float(price)
+    quotes["commission"][c, e] = float(commission)
+    quotes["has_sell"][c, e] = True
+
+def add_pair_quote(quotes, coin, currency, exchange, bid, ask, commission, network_fee=0):
+    # bid: what the exchange pays in currency for one coin, ask: what it
+    # charges for one. Either can be None. network_fee: coin lost when
+    # withdrawing what was bought.
+    quotes["pairs"].append({
+        "coin": coin,
+        "currency": currency,
+        "exchange": exchange,
+        "bid": float(bid) if bid is not None else None,
+        "ask": float(ask) if ask is not None else None,
+        "commission": float(commission),
+        "network_fee": float(network_fee)
+    })
+
+def add_market_quote(quotes, coin, currency, exchange, bid, ask, commission):
+    # What the parsers of the selling exchanges call for every market: the
+    # pair is always kept, and bids in CONFIG["quote"] also go to the matrix.
+    add_pair_quote(quotes, coin, currency, exchange, bid, ask, commission)
+    if currency == CONFIG["quote"] and bid is not None:
+        set_sell_quote(quotes, coin, exchange, bid, commission)
+
+def split_market(market, separator=""):
+    # "BTC_ARS" -> ("BTC", "ARS"), "btcars" -> ("BTC", "ARS"), else None.
+    market = market.upper()
+    if separator != "":
+        parts = market.split(separator)
+        return (parts[0], parts[1]) if len(parts) == 2 else None
+    for currency in MARKET_CURRENCIES:
+        if market.endswith(currency) and len(market) > len(currency):
+            return market[:-len(currency)], currency
+    return None
+
+def get_quote_arrays(quotes):
+    n_coins = len(quotes["coins"])
+    n_exchanges = len(quotes["exchanges"])
+    arrays = {"coins": quotes["coins"], "exchanges": quotes["exchanges"]}
+    for field in ["buy", "network_fee", "has_buy"]:
+        arrays[field] = quotes[field][:n_coins]
+    for field in ["sell", "commission", "has_sell"]:
+        arrays[field] = quotes[field][:n_coins, :n_exchanges]
+    return arrays
+
+def merge_quotes(quotes, other):
+    # Copies every quote present in other into quotes. Network fees are only
+    # copied when other knows one, as in set_buy_quote.
+    o = get_quote_arrays(other)
+    rows = np.array([get_coin_index(quotes, coin) for coin in o["coins"]], dtype=np.intp)
+    columns = np.array([get_exchange_index(quotes, exchange) for exchange in o["exchanges"]], dtype=np.intp)
+
+    if o["has_buy"].any():
+        bought = rows[o["has_buy"]]
+        quotes["buy"][bought] = o["buy"][o["has_buy"]]
+        quotes["has_buy"][bought] = True
+        with_fee = o["has_buy"] & (o["network_fee"] != 0)
+        quotes["network_fee"][rows[with_fee]] = o["network_fee"][with_fee]
+
+    c, e = np.nonzero(o["has_sell"])
+    cells = (rows[c], columns[e])
+    quotes["sell"][cells] = o["sell"][c, e]
+    quotes["commission"][cells] = o["commission"][c, e]
+    quotes["has_sell"][cells] = True
+
+    quotes["pairs"].extend(other["pairs"])
+    quotes["books"].update(other["books"])
+
+def get_usable_indexes(quotes):
+    # Rows of the coins that can be both bought and sold, and columns of the
+    # exchanges that buy at least one of them.
+    q = get_quote_arrays(quotes)
+    usable_coins = q["has_buy"] & q["has_sell"].any(axis=1)
+    coin_rows = np.flatnonzero(usable_coins)
+    exchange_columns = np.flatnonzero(q["has_sell"][usable_coins].any(axis=0))
+    return coin_rows, exchange_columns
+
+#-------------------------------------------------------------------------------
+# Order-book depth.
+# A book is the bid side of one coin's order book on one exchange, best price
+# first, with running sums of volume and notional so the average price of any
+# fill size is one binary search away. quotes["books"][(coin, exchange)]
+# holds the books fetched for the last snapshot (see add_depth_books). When
+# the books come from another venue than the exchange's quotes (ripio's app
+# vs. its exchange), they are priced as a column of their own.
+
+DEPTH_MAX_LEVELS = 200
+
+def new_book(prices, amounts):
+    prices = np.asarray(prices, dtype=np.float64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    order = np.argsort(-prices, kind="stable")[:DEPTH_MAX_LEVELS]
+    prices = prices[order]
+    amounts = amounts[order]
+    return {
+        "price": prices,
+        "volume": np.cumsum(amounts),
+        "notional": np.cumsum(prices*amounts)
+    }
+
+def set_book(quotes, coin, exchange, book):
+    if len(book["price"]) > 0:
+        quotes["books"][(coin, exchange)] = book
+
+def get_fill_price(book, quantities):
+    # Average price received for selling each of quantities into the book,
+    # NaN where the book is not deep enough to take it.
+    quantities = np.asarray(quantities, dtype=np.float64)
+    volume = book["volume"]
+    levels = np.searchsorted(volume, quantities, side="left")
+    filled = (levels < len(volume)) & (quantities > 0)
+    levels = np.minimum(levels, len(volume) - 1)
+    previous = levels - 1
+    volume_before = np.where(previous >= 0, volume[previous], 0.0)
+    notional_before = np.where(previous >= 0, book["notional"][previous], 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fill_prices = (notional_before + (quantities - volume_before)*book["price"][levels])/quantities
+    return np.where(filled, fill_prices, np.nan)
+
+#-------------------------------------------------------------------------------
+
+def get_json_loader(backend="auto"):
+    # orjson parses bytes directly and is several times faster than the
+    # standard library; "auto" uses it when it is installed.
+    if backend in ["auto", "orjson"]:
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if backend == "orjson":
+                raise
+    return json.loads
+
+json_loads = None
+
+def load_json(raw):
+    # raw is the response body as bytes (or str, from recorded snapshots).
+    global json_loads
+    if json_loads is None:
+        json_loads = get_json_loader(CONFIG["json_backend"])
+    return json_loads(raw)
+
+def process_info_bit2me(requests_res, rates, error_log):
+    if has_key(requests_res, "bit2me"):
+        bit2me_ticker = load_json(requests_res["bit2me"])["data"]
+        for item in bit2me_ticker:
+            # ticker2 only quotes EUR.
+            add_pair_quote(rates, item["symbol"], "EUR", "bit2me", None, item["buy"], BIT2ME_COMMISSION, item["network_fee"])
+            if CONFIG["base"] == "EUR":
+                set_buy_quote(rates, item["symbol"], item["buy"], item["network_fee"])
+
+def process_info_bit2me_new(requests_res, rates, error_log):
+    for name, raw in requests_res.items():
+        if get_endpoint_exchange(name) != "bit2me_new":
+            continue
+        currencies = get_bit2me_chunk_currencies(name)
+        bit2me_new_ticker = load_json(raw)
+        if isinstance(bit2me_new_ticker, dict):
+            bit2me_new_ticker = [bit2me_new_ticker.get(currency) for currency in currencies]
+        if len(bit2me_new_ticker) != len(currencies):
+            error_log.append("bit2me_new sent " + str(len(bit2me_new_ticker)) + " prices for " + str(len(currencies)) + " currencies, ignoring them")
+            continue
+        for currency, price in zip(currencies, bit2me_new_ticker):
+            if price is not None:
+                add_pair_quote(rates, currency, CONFIG["base"], "bit2me", None, price, BIT2ME_COMMISSION)
+                set_buy_quote(rates, currency, price)
+
+def process_info_ripio(requests_res, rates, error_log):
     if has_key(requests_res, "ripio"):
-        ripio_ticker = json.loads(requests_res["ripio"])
+        ripio_ticker = load_json(requests_res["ripio"])
         for item in ripio_ticker:
-            currency = item["ticker"][:-4]
-            if has_key(rates, currency) == False:
-                rates[currency] = {}
-            if has_key(rates[currency], "sell") == False:
-                rates[currency]["sell"] = {}
-            rates[currency]["sell"]["ripio"] = item["sell_rate"]
-            if has_key(rates[currency], "commission") == False:
-                rates[currency]["commission"] = {}
-            rates[currency]["commission"]["ripio"] = 0.01
+            market = split_market(item["ticker"], "_")
+            if market is None:
+                error_log.append("Error while processing ripio data for: " + item["ticker"])
+                continue
+            add_market_quote(rates, *market, "ripio", item.get("sell_rate"), item.get("buy_rate"), 0.01)
+
+def process_depth_ripio(raw):
+    book = load_json(raw)
+    return new_book([level["price"] for level in book["buy"]], [level["amount"] for level in book["buy"]])
 
 def process_info_satoshitango(requests_res, rates, error_log):
     if has_key(requests_res, "sat. t."):
-        satoshitango_ticker = json.loads(requests_res["sat. t."])["data"]["ticker"]
+        satoshitango_ticker = load_json(requests_res["sat. t."])["data"]["ticker"]
         for currency, info in satoshitango_ticker.items():
-            if has_key(rates, currency) == False:
-                rates[currency] = {}
-            if has_key(rates[currency], "sell") == False:
-                rates[currency]["sell"] = {}
             try:
-                rates[currency]["sell"]["sat. t."] = info["bid"]
-                if has_key(rates[currency], "commission") == False:
-                    rates[currency]["commission"] = {}
-                rates[currency]["commission"]["sat. t."] = 0.01
+                # The endpoint only quotes ARS.
+                add_market_quote(rates, currency, "ARS", "sat. t.", info["bid"], info.get("ask") or None, 0.01)
             except TypeError:
                 error_log.append("Error while processing satoshitango data for: " + currency)
 
-def process_info_buenbit(requests_res, rates):
+def process_info_buenbit(requests_res, rates, error_log):
     if has_key(requests_res, "buenbit"):
-        buenbit_ticker = json.loads(requests_res["buenbit"])["object"]
+        buenbit_ticker = load_json(requests_res["buenbit"])["object"]
         for currency_pair, info in buenbit_ticker.items():
-            if currency_pair[-3:] == "ars":
-                currency = currency_pair[:-3].upper()
-                if has_key(rates, currency) == False:
-                    rates[currency] = {}
-                if has_key(rates[currency], "sell") == False:
-                    rates[currency]["sell"] = {}
-                rates[currency]["sell"]["buenbit"] = info["purchase_price"]
-                if has_key(rates[currency], "commission") == False:
-                    rates[currency]["commission"] = {}
-                rates[currency]["commission"]["buenbit"] = 0 # comisión incluida en el precio
-
-def process_info_argenbtc(requests_res, rates):
+            if has_key(info, "bid_currency") and has_key(info, "ask_currency"):
+                market = (info["bid_currency"].upper(), info["ask_currency"].upper())
+            else:
+                market = split_market(currency_pair)
+            if market is None:
+                error_log.append("Error while processing buenbit data for: " + currency_pair)
+                continue
+            add_market_quote(rates, *market, "buenbit", info.get("purchase_price"), info.get("selling_price"), 0) # comisión incluida en el precio
+
+def process_info_argenbtc(requests_res, rates, error_log):
     if has_key(requests_res, "argenbtc"):
-      argenbtc_ticker_soup = BeautifulSoup(requests_res["argenbtc"])
-      argenbtc_buy_price = argenbtc_ticker_soup.find(id="span_precio_compra")
+      from bs4 import BeautifulSoup # only needed when argenbtc is enabled
+      argenbtc_ticker_soup = BeautifulSoup(requests_res["argenbtc"], "html.parser")
+      argenbtc_buy_price = argenbtc_ticker_soup.find(id="span_precio_compra").get_text()
       argenbtc_buy_price = float(argenbtc_buy_price.replace(" ARS", ""))
-      currency = "BTC"
-      if has_key(rates, currency) == False:
-        rates[currency] = {}
-      if has_key(rates[currency], "sell") == False:
-        rates[currency]["sell"] = {}
-      rates[currency]["sell"]["argenbtc"] = argenbtc_buy_price
-      if has_key(rates[currency], "commission") == False:
-        rates[currency]["commission"] = {}
-      rates[currency]["commission"]["argenbtc"] = 0 # comisión incluida en el precio
+      add_market_quote(rates, "BTC", "ARS", "argenbtc", argenbtc_buy_price, None, 0) # comisión incluida en el precio
+
+#-------------------------------------------------------------------------------
+# Exchange adapters. Each exchange declares its endpoint, its parser and the
+# modules the parser imports; parsers run in registration order. Exchanges can
+# be switched on and off in exchanges.json ({"argenbtc": true, ...}) or with
+# --enable / --disable.
+
+EXCHANGES = {}
+EXCHANGES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "exchanges.json")
+
+def register_exchange(exchange, endpoint, parser, requires=[], enabled=True, depth_endpoint=None, depth_parser=None, depth_venue=None, depth_commission=0):
+    # depth_endpoint(coin, currency) gives the URL of the coin's order book
+    # and depth_parser(raw) turns it into a book (see new_book). depth_venue
+    # names the column of books that don't come from the venue of the
+    # exchange's quotes, sold into with depth_commission.
+    EXCHANGES[exchange] = {
+        "endpoint": endpoint,
+        "parser": parser,
+        "requires": requires,
+        "enabled": enabled,
+        "depth_endpoint": depth_endpoint,
+        "depth_parser": depth_parser,
+        "depth_venue": depth_venue,
+        "depth_commission": depth_commission
+    }
+
+register_exchange("bit2me_new", get_bit2me_endpoint, process_info_bit2me_new)
+register_exchange("bit2me", "https://api.bit2me.com/v1/ticker2/", process_info_bit2me, enabled=False)
+register_exchange("ripio", "https://app.ripio.com/api/v3/rates/?country=AR", process_info_ripio,
+    depth_endpoint=lambda coin, currency: "https://api.exchange.ripio.com/api/v1/orderbook/" + coin.lower() + "_" + currency.lower() + "/",
+    depth_parser=process_depth_ripio, depth_venue="ripio ex.", depth_commission=0.01)
+register_exchange("sat. t.", "https://api.satoshitango.com/v3/ticker/ARS", process_info_satoshitango)
+register_exchange("buenbit", "https://be.buenbit.com/api/market/tickers/", process_info_buenbit)
+register_exchange("argenbtc", "https://argenbtc.com/cotizacion", process_info_argenbtc, requires=["bs4"], enabled=False)
+
+def set_exchanges_enabled(exchanges, enabled):
+    for exchange in exchanges:
+        if has_key(EXCHANGES, exchange) == False:
+            print("Unknown exchange '" + exchange + "'. Known exchanges: " + ", ".join(EXCHANGES), file=get_message_stream())
+            continue
+        EXCHANGES[exchange]["enabled"] = enabled
+
+def configure_exchanges(enable=[], disable=[], exchanges_file=EXCHANGES_FILE):
+    if os.path.exists(exchanges_file):
+        with open(exchanges_file, encoding="utf-8") as f:
+            for exchange, enabled in json.load(f).items():
+                set_exchanges_enabled([exchange], enabled)
+    set_exchanges_enabled(enable, True)
+    set_exchanges_enabled(disable, False)
+
+    # Checked without importing anything.
+    for exchange, adapter in EXCHANGES.items():
+        for module in adapter["requires"]:
+            if adapter["enabled"] and importlib.util.find_spec(module) is None:
+                print("Disabling '" + exchange + "': it needs the '" + module + "' package", file=get_message_stream())
+                adapter["enabled"] = False
+
+def get_depth_endpoints(quotes):
+    # {(coin, exchange): (url, venue)} for every sellable cell whose exchange
+    # has an order-book endpoint; venue is the column its book prices.
+    depth_endpoints = {}
+    coin_rows, exchange_columns = get_usable_indexes(quotes)
+    for e in exchange_columns:
+        exchange = quotes["exchanges"][e]
+        if has_key(EXCHANGES, exchange) == False or EXCHANGES[exchange]["depth_endpoint"] is None:
+            continue
+        venue = EXCHANGES[exchange]["depth_venue"] or exchange
+        for c in coin_rows:
+            if quotes["has_sell"][c, e]:
+                coin = quotes["coins"][c]
+                depth_endpoints[(coin, exchange)] = (EXCHANGES[exchange]["depth_endpoint"](coin, CONFIG["quote"]), venue)
+    return depth_endpoints
+
+def get_depth_endpoint_name(venue, coin):
+    # Its own latency history: books are not the exchange's ticker.
+    return venue + " book:" + coin
+
+async def add_depth_books(quotes, error_log, client=None, started=None):
+
+    # quotes plus freshly fetched order books when CONFIG["depth"] is set, as
+    # a copy: quotes can be the merged matrix process_all_info reuses. Cells
+    # without a book keep the top-of-book price. Skipped while replaying:
+    # snapshots only hold the tickers. started: the perf_counter() time the
+    # check began, so books only get what is left of CONFIG["budget"].
+
+    if CONFIG["depth"] == False or CONFIG["endpoints"] is not None:
+        return quotes
+    budget = CONFIG["budget"]
+    if budget is not None and started is not None:
+        budget -= time.perf_counter() - started
+        if budget <= 0:
+            error_log.append("No order books: the " + str(CONFIG["budget"]) + "s budget was spent on the rates")
+            return quotes
+    books_quotes = new_quotes()
+    merge_quotes(books_quotes, quotes)
+    books_quotes["books"] = {}
+    quotes = books_quotes
+    depth_endpoints = get_depth_endpoints(quotes)
+    endpoints = {get_depth_endpoint_name(venue, coin): url for (coin, exchange), (url, venue) in depth_endpoints.items()}
+    depth_res = await run_requests(endpoints, error_log, client, CONFIG["deadlines"], budget, default_deadline=CONFIG["default_deadline"])
+    for (coin, exchange), (url, venue) in depth_endpoints.items():
+        name = get_depth_endpoint_name(venue, coin)
+        if has_key(depth_res, name) == False:
+            continue
+        try:
+            book = EXCHANGES[exchange]["depth_parser"](depth_res[name])
+        except Exception as e:
+            error_log.append("Error while reading the order book '" + name + "': " + str(e))
+            continue
+        set_book(quotes, coin, venue, book)
+        if venue != exchange and len(book["price"]) > 0:
+            set_sell_quote(quotes, coin, venue, book["price"][0], EXCHANGES[exchange]["depth_commission"])
+    return quotes
 
 def get_all_sell_exchanges(rates):
-    
-    # Example: rates[currency]["sell"]["ripio"]
-    
-    sell_exchanges = []
-    for currency, data in rates.items():
-        if has_key(data, "buy") and has_key(data, "sell"):
-            for sell_exchange, rate in data["sell"].items():
-                if sell_exchange not in sell_exchanges:
-                    sell_exchanges.append(sell_exchange)
-    return sell_exchanges
+    coin_rows, exchange_columns = get_usable_indexes(rates)
+    return [rates["exchanges"][e] for e in exchange_columns]
 
 def get_all_usable_coins(rates):
-    bought_coins = []
-    unit_prices_in_EUR = []
-    for coin, data in rates.items():
-        if has_key(data, "buy") and has_key(data, "sell"):
-            bought_coins.append(coin)
-            unit_prices_in_EUR.append(data["buy"])
-    return bought_coins, unit_prices_in_EUR
+    coin_rows, exchange_columns = get_usable_indexes(rates)
+    bought_coins = [rates["coins"][c] for c in coin_rows]
+    unit_prices_in_base = rates["buy"][coin_rows].tolist()
+    return bought_coins, unit_prices_in_base
 
 def get_coins_that_cannot_be_sold(rates):
-    
-    # Example: rates[currency]["sell"]["ripio"]
-    
-    coins_that_cannot_be_sold = []
-
-    for coin, data in rates.items():
-        if has_key(data, "sell") == False:
-            coins_that_cannot_be_sold.append(coin)
+    q = get_quote_arrays(rates)
+    coins_that_cannot_be_sold = [q["coins"][c] for c in np.flatnonzero(~q["has_sell"].any(axis=1))]
 
     if len(coins_that_cannot_be_sold) > 0:
         return coins_that_cannot_be_sold
@@ -190,57 +1035,191 @@ def get_coins_that_cannot_be_sold(rates):
         return "-"
 
 def get_coins_that_cannot_be_bought(rates):
-    
-    # Example: rates[currency]["sell"]["ripio"]
-    
-    coins_that_cannot_be_bought = []
-
-    for coin, data in rates.items():
-        if has_key(data, "buy") == False:
-            coins_that_cannot_be_bought.append(coin)
+    q = get_quote_arrays(rates)
+    coins_that_cannot_be_bought = [q["coins"][c] for c in np.flatnonzero(~q["has_buy"])]
 
     if len(coins_that_cannot_be_bought) > 0:
         return coins_that_cannot_be_bought
     else:
         return "-"
 
-def get_user_input(input_message="Ingrese monto a vender (EUR). \"c\" para cancelar: "):
-    EUR_amount = ""
+def get_rates_matrix(amounts, rates):
+
+    # The rate math of every table, record and route: one NumPy pass over
+    # amounts x coins x exchanges, all from the same fetched snapshot.
+    # rates_matrix["rates"][a, c, e] is the quote/base rate obtained by buying
+    # coins[c] on bit2me with amounts[a] of CONFIG["base"] and selling it for
+    # CONFIG["quote"] on exchanges[e]
+    # (NaN when the coin cannot be sold there). Cells with an order book sell
+    # at the average fill price of each amount instead of the top of the book;
+    # rates_matrix["top_rates"] keeps the top-of-book rates.
+
+    amounts = np.asarray(amounts, dtype=np.float64).reshape(-1)
+    coin_rows, exchange_columns = get_usable_indexes(rates)
+    coins = [rates["coins"][c] for c in coin_rows]
+    exchanges = [rates["exchanges"][e] for e in exchange_columns]
+
+    buy_prices = rates["buy"][coin_rows]
+    network_fees = rates["network_fee"][coin_rows]
+    cells = np.ix_(coin_rows, exchange_columns)
+    sell_prices = np.where(rates["has_sell"][cells], rates["sell"][cells], np.nan)
+    commissions = rates["commission"][cells]
+
+    # amounts x coins
+    coins_transfered = amounts[:, None]*(1-BIT2ME_COMMISSION)/buy_prices[None, :] - network_fees[None, :]
+    # amounts x coins x exchanges
+    fill_prices = np.broadcast_to(sell_prices, (len(amounts), *sell_prices.shape)).copy()
+    for (coin, exchange), book in rates["books"].items():
+        if coin in coins and exchange in exchanges:
+            c = coins.index(coin)
+            e = exchanges.index(exchange)
+            fill_prices[:, c, e] = get_fill_price(book, coins_transfered[:, c])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        top_rates = coins_transfered[:, :, None]*(sell_prices*(1-commissions))[None, :, :]/amounts[:, None, None]
+        rates_by_amount = coins_transfered[:, :, None]*fill_prices*(1-commissions)[None, :, :]/amounts[:, None, None]
+
+    return {
+        "amounts": amounts,
+        "coins": coins,
+        "exchanges": exchanges,
+        "coins_transfered": coins_transfered,
+        "rates": rates_by_amount,
+        "top_rates": top_rates,
+        "depth": len(rates["books"]) > 0
+    }
+
+def get_best_routes(rates_matrix):
+
+    # Best (coin, exchange, rate) for every amount, or None if nothing can be sold.
+
+    amounts = rates_matrix["amounts"]
+    rates_by_amount = rates_matrix["rates"]
+    n_exchanges = len(rates_matrix["exchanges"])
+    best_routes = []
+    if rates_by_amount.size == 0:
+        return [None for amount in amounts]
+
+    flat_rates = np.where(np.isnan(rates_by_amount), -np.inf, rates_by_amount).reshape(len(amounts), -1)
+    best_cells = np.argmax(flat_rates, axis=1)
+    best_rates = flat_rates[np.arange(len(amounts)), best_cells]
+    for i in range(len(amounts)):
+        if np.isfinite(best_rates[i]):
+            coin = rates_matrix["coins"][best_cells[i] // n_exchanges]
+            exchange = rates_matrix["exchanges"][best_cells[i] % n_exchanges]
+            best_routes.append((coin, exchange, float(best_rates[i])))
+        else:
+            best_routes.append(None)
+    return best_routes
+
+def read_amounts(amounts_arg=None, amounts_file=None):
+    amounts = []
+    if amounts_arg:
+        amounts.extend(float(amount) for amount in amounts_arg.split(",") if amount.strip() != "")
+    if amounts_file:
+        with open(amounts_file) as f:
+            amounts.extend(float(line) for line in f if line.strip() != "")
+    return amounts
+
+def print_best_routes(rates_matrix):
+    x = prettytable.PrettyTable()
+    x.field_names = [CONFIG["base"], "coin", "exchange", CONFIG["quote"] + "/" + CONFIG["base"]] + (["slippage %"] if rates_matrix["depth"] else [])
+    for a, (amount, route) in enumerate(zip(rates_matrix["amounts"], get_best_routes(rates_matrix))):
+        if route is None:
+            x.add_row([round(amount, 2), "-", "-", "-"] + (["-"] if rates_matrix["depth"] else []))
+        else:
+            coin, exchange, rate = route
+            row = [round(amount, 2), coin, exchange, round(rate, 2)]
+            if rates_matrix["depth"]:
+                top_rate = rates_matrix["top_rates"][a, rates_matrix["coins"].index(coin), rates_matrix["exchanges"].index(exchange)]
+                row.append(round(100*(1 - rate/top_rate), 3))
+            x.add_row(row)
+    x.align = "r"
+    print(x.get_string())
+
+def get_message_stream():
+    # With --output the records own stdout, so prompts, warnings and
+    # profiles go to stderr.
+    return sys.stdout if CONFIG["output"] == "table" else sys.stderr
+
+def read_line(message):
+    if get_message_stream() is sys.stderr:
+        sys.stderr.write(message)
+        sys.stderr.flush()
+        return input()
+    return input(message)
+
+def get_user_input(input_message=None):
+    if input_message is None:
+        input_message = "Ingrese monto a vender (" + CONFIG["base"] + "). \"c\" para cancelar: "
+    base_amount = ""
     try:
-        EUR_amount = float(input(input_message))
-        return EUR_amount
+        base_amount = float(read_line(input_message))
+        return base_amount
     except:
-        if EUR_amount == "c":
+        if base_amount == "c":
             return False
         else:
-            EUR_amount = get_user_input("No se ingresó un valor válido. Intente de nuevo, o use \"c\" para cancelar: ")
+            base_amount = get_user_input("No se ingresó un valor válido. Intente de nuevo, o use \"c\" para cancelar: ")
 
-def check_rates(EUR_amount):
+# What each exchange's parser produced from its last body:
+# {exchange: (raw, quotes, errors)}, and the last merged result.
+parsed_quotes = {}
+last_processed = {"sources": None, "quotes": None}
 
-    error_log = []
+def process_all_info(requests_res, error_log, metrics=None):
 
-    table_timestamp = datetime.now(tz=None)
-    table_timestamp = table_timestamp.strftime("%Y-%m-%d %H:%M")
-    
-    endpoints = get_all_endpoints()
-
-    requests_res = trio.run(run_requests, endpoints, error_log)
-    # requests_res = {'bit2me_new': [12186.462522, 208.3010982, 345.94368119999996, 47.51205419999999, 55.5046167, 0.20437088879999998, 0.08168782517999999, 9.0383647926, 75.5094678, 3.774279834, 0.8608266887999999, 100.3695342, 2.4143071734599997, 3.5232920579999996, 0.0020290452000000002, 0.06399762017999999, 0.853477794, 0.852625254, 46.412277599999996, 1.615051776, 1.65904284], 'bit2me': {'code': 200, 'data': [{'symbol': 'BTC', 'name': 'Bitcoin', 'base': 'EUR', 'buy': 12535.2, 'buy_url': 'https://bit2me.com/buy-bitcoin', 'sell': 11805, 'sell_url': 'https://bit2me.com/sell-bitcoin', 'active': True, 'network_fee': 0.0002, 'icon': 'https://bit2me.com/assets/images/crypto-logos/btc.svg'}, {'symbol': 'ETH', 'name': 'Ethereum', 'base': 'EUR', 'buy': 357.01, 'buy_url': 'https://bit2me.com/buy-ethereum', 'sell': 336.21, 'sell_url': 'https://bit2me.com/sell-ethereum', 'active': True, 'network_fee': 0.008, 'icon': 'https://bit2me.com/assets/images/crypto-logos/eth.svg'}, {'symbol': 'LTC', 'name': 'Litecoin', 'base': 'EUR', 'buy': 49, 'buy_url': 'https://bit2me.com/buy-litecoin', 'sell': 46.14, 'sell_url': 'https://bit2me.com/sell-litecoin', 'active': True, 'network_fee': 0.02, 'icon': 'https://bit2me.com/assets/images/crypto-logos/ltc.svg'}, {'symbol': 'BCH', 'name': 'Bitcoin Cash', 'base': 'EUR', 'buy': 214.55, 'buy_url': 'https://bit2me.com/buy-bitcoin-cash', 'sell': 202.05, 'sell_url': 'https://bit2me.com/sell-bitcoin-cash', 'active': True, 'network_fee': 0.003, 'icon': 'https://bit2me.com/assets/images/crypto-logos/bch.svg'}, {'symbol': 'DASH', 'name': 'Dash', 'base': 'EUR', 'buy': 57.16, 'buy_url': 'https://bit2me.com/buy-dash', 'sell': 53.83, 'sell_url': 'https://bit2me.com/sell-dash', 'active': True, 'network_fee': 0.001, 'icon': 'https://bit2me.com/assets/images/crypto-logos/dash.svg'}]}, 'sat. t.': {'data': {'ticker': {'BTC': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 2133245.36, 'ask': 2248864.53, 'high': 0, 'low': 0, 'volume': 0}, 'ETH': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 60565.95, 'ask': 64050.19, 'high': 0, 'low': 0, 'volume': 0}, 'LTC': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 8280.2, 'ask': 8800.39, 'high': 0, 'low': 0, 'volume': 0}, 'XRP': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 35.82, 'ask': 37.76, 'high': 0, 'low': 0, 'volume': 0}, 'BCH': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 36372.76, 'ask': 38455.91, 'high': 0, 'low': 0, 'volume': 0}, 'DAI': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 150.29, 'ask': 159.54, 'high': 0, 'low': 0, 'volume': 0}, 'USDC': {'date': '2020-11-05 02:23:02', 'timestamp': 1604542982, 'bid': 149.58, 'ask': 157.29, 'high': 0, 'low': 0, 'volume': 0}}, 'code': 'success'}}, 'qubit': {'BTC': [1, '14274.6500', '2119785.5250', '3.2333'], 'NEO': ['0.001004087665897237410374334922', '14.3330', '2128.4505', '-1.1654'], 'QTUM': ['0.0001292501042057073203195875205', '1.8450', '273.9825', '-0.3241'], 'ADA': ['0.000006699288599019940944261330400', '0.0956', '14.2011', '2.9941'], 'EOS': ['0.0001663718550016988157327850420', '2.3749', '352.6726', '1.2276'], 'IOTA': ['0.00001670794029976216579741009412', '0.2385', '35.4172', '-2.6531'], 'XLM': ['0.000005240058425250356401032599749', '0.0748', '11.1078', '-0.1068'], 'ETC': ['0.0003426493819463174228439926723', '4.8912', '726.3432', '1.1143'], 'ICX': ['0.00002206709096195003029846616204', '0.3150', '46.7775', '1.0263'], 'BNB': ['0.001920964787227707859737366590', '27.4211', '4072.0334', '2.7011'], 'ETH': ['0.02844202835095781682913416441', '406.0000', '60291.0000', '5.8477'], 'LINK': ['0.0007404734967232121277929756596', '10.5700', '1569.6450', '3.0094'], 'BCH': ['0.01706871972342579327689295359', '243.6500', '36182.0250', '0.5904'], 'USDT': ['0.00007005425702206358824909892712', '1.0000', '148.5000', 0], 'DAI': ['0.00007005425702206358824909892712', '1.0000', '148.5000', 0], 'PAX': ['0.00007005425702206358824909892712', '1.0000', '148.5000', 0], 'TUSD': ['0.00006999120819074373101967473808', '0.9991', '148.3664', '-0.0100'], 'XRP': ['0.00001681092005758459927213626954', '0.2400', '35.6355', '0.2548'], 'LTC': ['0.003902022116128941865474810241', '55.7000', '8271.4500', '5.0349']}, 'argenbtc': {'precio_compra': 2290816.45, 'precio_venta': 2209460.4, 'precio_compra_f': '2.290.816', 'precio_venta_f': '2.209.460', 'date_cotizacion': '23:23:44'}, 'ripio': [{'ticker': 'USDC_ARS', 'buy_rate': '160.64', 'sell_rate': '154.31', 'variation': '-0.19'}, {'ticker': 'ETH_ARS', 'buy_rate': '68635.99', 'sell_rate': '61831.26', 'variation': '1.05'}, {'ticker': 'DAI_ARS', 'buy_rate': '163.47', 'sell_rate': '154.97', 'variation': '0.01'}, {'ticker': 'LTC_ARS', 'buy_rate': '9431.30', 'sell_rate': '8496.26', 'variation': '1.99'}, {'ticker': 'BTC_ARS', 'buy_rate': '2299179.82', 'sell_rate': '2208426.48', 'variation': '0.93'}], 'buenbit': {'object': {'daiars': {'price_change_percent': '-4.42%', 'price': '156.75', 'currency': 'AR$', 'ask_currency': 'ars', 'bid_currency': 'dai', 'purchase_price': '153.7', 'selling_price': '159.8', 'market_identifier': 'daiars'}, 'daiusd': {'price_change_percent': '-3.81%', 'price': '1.03', 'currency': 'U$D', 'ask_currency': 'usd', 'bid_currency': 'dai', 'purchase_price': '1.01', 'selling_price': '1.05', 'market_identifier': 'daiusd'}, 'btcars': {'price_change_percent': '+6.40%', 'price': '2212750.0', 'currency': 'AR$', 'ask_currency': 'ars', 'bid_currency': 'btc', 'purchase_price': '2169400.0', 'selling_price': '2256100.0', 'market_identifier': 'btcars'}}, 'errors': []}}
     # print(requests_res)
 
-    processed_rates = {}
+    # Every exchange is parsed into its own quote matrix and merged. An
+    # exchange whose body hasn't changed (a 304, an unchanged poll, a stale
+    # answer) reuses the matrix parsed last time.
+
+    processed_rates = new_quotes()
+    sources = []
+
+    for exchange, adapter in EXCHANGES.items():
+        if adapter["enabled"] == False:
+            continue
+        for name in [name for name in requests_res if get_endpoint_exchange(name) == exchange]:
+            raw = requests_res[name]
+            cached = parsed_quotes.get(name)
+            start = time.perf_counter()
+            if cached is not None and (cached[0] is raw or cached[0] == raw):
+                exchange_quotes, exchange_errors = cached[1], cached[2]
+            else:
+                exchange_quotes = new_quotes()
+                exchange_errors = []
+                adapter["parser"]({name: raw}, exchange_quotes, exchange_errors)
+                parsed_quotes[name] = (raw, exchange_quotes, exchange_errors)
+            error_log.extend(exchange_errors)
+            sources.append(exchange_quotes)
+            if metrics is not None:
+                metrics.setdefault("exchanges", {}).setdefault(get_endpoint_label(name), {})["parse_s"] = time.perf_counter() - start
+
+    # Nothing changed at all: the merged matrix from last time is still valid.
+    if last_processed["sources"] is not None and len(sources) == len(last_processed["sources"]) and all(a is b for a, b in zip(sources, last_processed["sources"])):
+        return last_processed["quotes"]
+
+    for exchange_quotes in sources:
+        merge_quotes(processed_rates, exchange_quotes)
+    last_processed["sources"] = sources
+    last_processed["quotes"] = processed_rates
+    return processed_rates
 
-    process_info_bit2me_new(requests_res, processed_rates)
-    process_info_ripio(requests_res, processed_rates)
-    process_info_satoshitango(requests_res, processed_rates, error_log)
-    process_info_buenbit(requests_res, processed_rates)
-    # process_info_argenbtc(requests_res, processed_rates)
+def format_coins_transfered(coins_transfered):
+    decimal_places = max(COL_WIDTH - str(coins_transfered).find(".") - 2, 0)
+    return str(round(coins_transfered, decimal_places))
+
+def format_rate(rate):
+    return str(round(rate, 2))
+
+def print_rates_table(base_amount, processed_rates, table_timestamp, error_log, stale={}, missing=[], metrics=None):
 
     # print(processed_rates)
-    coins_that_cannot_be_sold = get_coins_that_cannot_be_sold(processed_rates)
-    coins_that_cannot_be_bought = get_coins_that_cannot_be_bought(processed_rates)
-    
-    usable_coins, unit_prices_in_EUR = get_all_usable_coins(processed_rates)
+    start = time.perf_counter()
+    rates_matrix = get_rates_matrix([base_amount], processed_rates)
+    usable_coins = rates_matrix["coins"]
+    exchanges = rates_matrix["exchanges"]
 
     column_headers_exchange = []
     for coin in usable_coins:
@@ -249,54 +1228,42 @@ def check_rates(EUR_amount):
     column_headers_coins = []
     column_headers_coins.extend(usable_coins)
     
-    column_headers_amount_bought = []
+    # Table headers (buy at this price).
+    column_headers_amount_bought = [format_coins_transfered(float(coins_transfered)) for coins_transfered in rates_matrix["coins_transfered"][0]]
 
-    exchanges = get_all_sell_exchanges(processed_rates)
+    # One row per exchange; "-" where the coin isn't sold there or the amount
+    # is deeper than the order book.
     exchanges_data = {}
-    for exchange in exchanges:
-        exchanges_data[exchange] = []
-
-    for coin in usable_coins:
-
-        data = processed_rates[coin]
-        # Table headers (buy at this price) --------------------------------
-        # bit2me_comission = 0.03 # bit2me old
-        bit2me_comission = 0.025 # bit2me new
-        buy_price = processed_rates[coin]["buy"]
-        network_fee = processed_rates[coin]["network_fee"]
-        usable_coins = EUR_amount*(1-bit2me_comission)/buy_price
-        coins_transfered = usable_coins - network_fee
-        decimal_places = max(COL_WIDTH - str(coins_transfered).find(".") - 2, 0)
-        column_headers_amount_bought.append(str(round(coins_transfered, decimal_places)))
-        # ------------------------------------------------------------------
-
-        # Construct one column per coin.
-        for exchange in exchanges:
-            if has_key(processed_rates[coin]["sell"], exchange):
-                sell_price = processed_rates[coin]["sell"][exchange]
-                exchange_commission = float(processed_rates[coin]["commission"][exchange])
-                ARS_received = float(coins_transfered)*float(sell_price)
-                ARS_commission_payed = ARS_received*exchange_commission
-                ARS_amount = ARS_received - ARS_commission_payed
-
-                rate = float(ARS_amount)/float(EUR_amount)
-                exchanges_data[exchange].append(str(round(rate, 2)))
-            else:
-                exchanges_data[exchange].append("-")
+    for e, exchange in enumerate(exchanges):
+        exchanges_data[exchange] = ["-" if np.isnan(rate) else format_rate(float(rate)) for rate in rates_matrix["rates"][0, :, e]]
     
+    render_start = time.perf_counter()
     print("Table timestamp ↓: " + str(table_timestamp))
-    x = PrettyTable()
+    x = prettytable.PrettyTable()
     x.field_names = range(len(column_headers_exchange)+1)
     x.add_row(["", *column_headers_exchange])
     x.add_row(["", *column_headers_coins])
     x.add_row(["Sell at ↓", *column_headers_amount_bought])
     x.add_row([DIVIDER_STRING for i in range(len(column_headers_exchange)+1)])
     for exchange, row in exchanges_data.items():
-        x.add_row([exchange, *row])
+        x.add_row([exchange + ("*" if has_key(stale, exchange) else ""), *row])
     x.align = "r"
     x.header = False
     print(x.get_string())
+    if metrics is not None:
+        metrics["compute_s"] = render_start - start
+        metrics["render_s"] = time.perf_counter() - render_start
+
+    print_rates_footer(processed_rates, error_log, stale, missing)
+
+def print_rates_footer(processed_rates, error_log, stale={}, missing=[]):
+    coins_that_cannot_be_sold = get_coins_that_cannot_be_sold(processed_rates)
+    coins_that_cannot_be_bought = get_coins_that_cannot_be_bought(processed_rates)
 
+    for exchange, timestamp in stale.items():
+        print("* Stale: no fresh answer from '" + exchange + "', showing its rates from " + timestamp.strftime("%H:%M:%S"))
+    if len(missing) > 0:
+        print("Missing (no answer in time): " + ", ".join(missing))
     print("The following coins cannot be sold at any of the provided exchanges: " + ", ".join(coins_that_cannot_be_sold))
     print("The following coins cannot be bought at any of the provided exchanges: " + ", ".join(coins_that_cannot_be_bought))
     if len(error_log) > 0:
@@ -304,14 +1271,1536 @@ def check_rates(EUR_amount):
             print(error_msg)
     print("")
 
+async def check_rates_async(base_amount, client=None):
+
+    error_log = []
+    stale = {}
+    missing = []
+
+    # Rates fetched by run_session are labelled and stored with the time
+    # they were fetched, not the time of the check.
+    fetch = take_prefetch()
+    timestamp = fetch["timestamp"] if fetch is not None else datetime.now(tz=None)
+    table_timestamp = timestamp.strftime("%Y-%m-%d %H:%M")
+
+    # The progressive table is drawn in place; records are written once.
+    warm = take_warm_start()
+    if (CONFIG["progressive"] or warm is not None) and CONFIG["output"] == "table" and sys.stdout.isatty():
+        await check_rates_progressive(base_amount, timestamp, client, warm, fetch)
+        return
+    if warm is not None and CONFIG["output"] == "table":
+        print_rates_table(base_amount, warm[0], warm[1].strftime("%Y-%m-%d %H:%M") + " (last known rates, " + format_age(warm[1]) + " old)", [])
+
+    metrics = new_metrics()
+    processed_rates = await get_processed_rates(error_log, client, stale, missing, metrics=metrics, warm=warm, fetch=fetch, timestamp=timestamp)
+    if CONFIG["output"] != "table":
+        write_rate_records(get_rate_records([base_amount], processed_rates, table_timestamp, stale), CONFIG["output"], error_log)
+    else:
+        print_rates_table(base_amount, processed_rates, table_timestamp, error_log, stale, missing, metrics)
+    report_metrics(metrics)
+
+async def check_rates_progressive(base_amount, timestamp, client=None, warm=None, fetch=None):
+
+    # Rows are drawn as soon as each exchange's answer has been processed,
+    # using the incremental redraw of watch mode. warm: (quotes, datetime) of
+    # the last known rates, drawn first and kept for the exchanges that
+    # haven't answered yet. fetch: the prefetch to join (see take_prefetch).
+
+    table_timestamp = timestamp.strftime("%Y-%m-%d %H:%M")
+    error_log = []
+    stale = {}
+    missing = []
+    progress = {"table": None, "requests_res": {}}
+
+    def draw(processed_rates, status, final=False, metrics=None):
+        start = time.perf_counter()
+        shown_rates = processed_rates
+        if warm is not None and final == False:
+            shown_rates = new_quotes()
+            merge_quotes(shown_rates, warm[0])
+            merge_quotes(shown_rates, processed_rates)
+        progress["table"] = get_watch_table(base_amount, shown_rates, progress["table"])
+        render_start = time.perf_counter()
+        draw_watch_table(progress["table"], status)
+        if metrics is not None:
+            metrics["compute_s"] = render_start - start
+            metrics["render_s"] = time.perf_counter() - render_start
+
+    def on_response(exchange, raw):
+        progress["requests_res"][exchange] = raw
+        draw(process_all_info(progress["requests_res"], []), "Table timestamp ↓: " + table_timestamp + " (waiting for more exchanges)")
+
+    if warm is not None:
+        draw(new_quotes(), "Table timestamp ↓: " + warm[1].strftime("%Y-%m-%d %H:%M") + " (last known rates, " + format_age(warm[1]) + " old; refreshing)")
+    metrics = new_metrics()
+    processed_rates = await get_processed_rates(error_log, client, stale, missing, on_response, metrics, warm, fetch, timestamp)
+    draw(processed_rates, "Table timestamp ↓: " + table_timestamp, final=True, metrics=metrics)
+    print_rates_footer(processed_rates, error_log, stale, missing)
+    report_metrics(metrics)
+
+async def get_processed_rates(error_log, client=None, stale=None, missing=None, on_response=None, metrics=None, warm=None, fetch=None, timestamp=None):
+
+    # The steps shared by both kinds of check: fetch (or join fetch, started
+    # by run_session), parse, order books, store, alerts and last known
+    # rates, the last two at timestamp. Exchanges that didn't answer then
+    # keep their warm rates, after saving, so old rows are shown but never
+    # stored as fresh.
+
+    started = time.perf_counter()
+    requests_res = None
+    if fetch is not None:
+        requests_res = await join_prefetch(fetch, error_log, stale, missing, on_response, metrics)
+    if requests_res is None:
+        requests_res = await get_requests_res(error_log, client, stale, missing, on_response, metrics)
+    processed_rates = process_all_info(requests_res, error_log, metrics)
+    processed_rates = await add_depth_books(processed_rates, error_log, client, started)
+    store_processed_rates(processed_rates, timestamp)
+    await check_alerts(processed_rates, client)
+    save_last_rates(processed_rates, timestamp)
+    if warm is not None:
+        processed_rates = keep_warm_rates(processed_rates, warm, stale, missing)
+    return processed_rates
+
+def check_rates(base_amount):
+    # One-shot check: own event loop and own client.
+    trio.run(check_rates_async, base_amount)
+
+async def sweep_amounts_async(amounts, client=None):
+
+    error_log = []
+    metrics = new_metrics()
+    started = time.perf_counter()
+    requests_res = await get_requests_res(error_log, client, metrics=metrics)
+    processed_rates = process_all_info(requests_res, error_log, metrics)
+    processed_rates = await add_depth_books(processed_rates, error_log, client, started)
+    store_processed_rates(processed_rates)
+    await check_alerts(processed_rates, client)
+    start = time.perf_counter()
+    if CONFIG["output"] != "table":
+        timestamp = datetime.now(tz=None).strftime("%Y-%m-%d %H:%M")
+        write_rate_records(get_rate_records(amounts, processed_rates, timestamp), CONFIG["output"], error_log)
+        metrics["compute_s"] = time.perf_counter() - start
+        report_metrics(metrics)
+        return
+    rates_matrix = get_rates_matrix(amounts, processed_rates)
+    metrics["compute_s"] = time.perf_counter() - start
+    print_best_routes(rates_matrix)
+    metrics["render_s"] = time.perf_counter() - start - metrics["compute_s"]
+    for error_msg in error_log:
+        print(error_msg)
+    report_metrics(metrics)
+    return rates_matrix
+
+async def run_session(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY):
+    # Whole interactive loop inside a single trio run, sharing one pooled
+    # client so DNS lookups and TCP/TLS handshakes happen only once.
+    async with get_http_client(max_connections, max_keepalive_connections, keepalive_expiry) as client:
+        async with trio.open_nursery() as nursery:
+            # With last known rates, fresh ones are fetched while the first
+            # amount is typed (see prefetch_rates).
+            if warm_start["quotes"] is not None:
+                nursery.start_soon(prefetch_rates, client)
+            base_amount = await trio.to_thread.run_sync(get_user_input)
+            while isinstance(base_amount, float) == True:
+                await check_rates_async(base_amount, client)
+                base_amount = await trio.to_thread.run_sync(get_user_input)
+            nursery.cancel_scope.cancel()
+
+#-------------------------------------------------------------------------------
+# Route search. Currencies are nodes and every quote is a directed edge,
+# weighted by its log rate net of commissions:
+#   pairs           bid*(1-commission) one way, (1-commission)/ask minus the
+#                   network fee the other (bit2me buys are asks in the base)
+# The best route maximises the sum of log rates. Log rates can be positive,
+# so this is a hop-limited Bellman-Ford rather than Dijkstra. Network fees
+# are a fixed amount of coin, so each edge's effective log rate depends on
+# how much flows through it: labels carry the amount reached, which gives
+# the same order as the summed log rates and keeps fees exact. Keeping the
+# k best labels per node and hop gives the top-k simple routes.
+
+ROUTES_TOP_K = 5
+ROUTES_MAX_HOPS = 4
+
+def add_graph_edge(graph, source, target, exchange, rate, fee=0):
+    if rate is None or rate <= 0 or math.isfinite(rate) == False:
+        return
+    graph.setdefault(source, []).append({
+        "target": target,
+        "exchange": exchange,
+        "rate": rate,
+        "log_rate": math.log(rate),
+        "fee": fee
+    })
+
+def get_rate_graph(quotes):
+    graph = {}
+    for pair in quotes["pairs"]:
+        if pair["bid"] is not None:
+            add_graph_edge(graph, pair["coin"], pair["currency"], pair["exchange"], pair["bid"]*(1-pair["commission"]))
+        if pair["ask"] is not None and pair["ask"] > 0:
+            add_graph_edge(graph, pair["currency"], pair["coin"], pair["exchange"], (1-pair["commission"])/pair["ask"], pair["network_fee"])
+    return graph
+
+def find_routes(graph, amount, source=BASE_CURRENCY, target=QUOTE_CURRENCY, top_k=ROUTES_TOP_K, max_hops=ROUTES_MAX_HOPS):
+
+    # Returns up to top_k routes from source to target, best first, as
+    # {"amount": received, "rate": received/amount, "steps": [(from, to, exchange), ...]}
+
+    found = []
+    frontier = {source: [(float(amount), [])]}
+    for hop in range(max_hops):
+        reached = {}
+        for node, labels in frontier.items():
+            for node_amount, steps in labels:
+                visited = [source] + [step[1] for step in steps]
+                for edge in graph.get(node, []):
+                    if edge["target"] in visited:
+                        continue
+                    received = node_amount*edge["rate"] - edge["fee"]
+                    if received <= 0:
+                        continue
+                    reached.setdefault(edge["target"], []).append((received, steps + [(node, edge["target"], edge["exchange"])]))
+        frontier = {}
+        for node, labels in reached.items():
+            best = heapq.nlargest(top_k, labels, key=lambda label: label[0])
+            if node == target:
+                found.extend(best)
+            else:
+                frontier[node] = best
+        if len(frontier) == 0:
+            break
+
+    return [{"amount": received, "rate": received/amount, "steps": steps} for received, steps in heapq.nlargest(top_k, found, key=lambda label: label[0])]
+
+def format_route(steps):
+    route = steps[0][0]
+    for source, target, exchange in steps:
+        route += " -" + exchange + "-> " + target
+    return route
+
+def print_routes(routes, amount, source=BASE_CURRENCY, target=QUOTE_CURRENCY):
+    x = prettytable.PrettyTable()
+    x.field_names = ["#", "route", target, target + "/" + source]
+    for i, route in enumerate(routes):
+        x.add_row([i+1, format_route(route["steps"]), round(route["amount"], 2), round(route["rate"], 2)])
+    x.align = "r"
+    x.align["route"] = "l"
+    print("Best routes for " + str(amount) + " " + source + ":")
+    print(x.get_string())
+
+async def find_routes_async(amount, top_k=ROUTES_TOP_K, max_hops=ROUTES_MAX_HOPS, client=None):
+    error_log = []
+    requests_res = await get_requests_res(error_log, client)
+    processed_rates = process_all_info(requests_res, error_log)
+    store_processed_rates(processed_rates)
+    routes = find_routes(get_rate_graph(processed_rates), amount, CONFIG["base"], CONFIG["quote"], top_k, max_hops)
+    print_routes(routes, amount, CONFIG["base"], CONFIG["quote"])
+    for error_msg in error_log:
+        print(error_msg)
+    return routes
+
+#-------------------------------------------------------------------------------
+# Cross rates. Every currency seen in quotes["pairs"] gets a row and a column,
+# and cross_rates["rates"][i, j] is the most of currencies[j] one unit of
+# currencies[i] buys in at most max_hops trades, net of commissions (network
+# fees are a fixed amount, so they are left to the route search). The direct
+# rates are scattered from all pairs at once and each extra hop is one
+# max-product of the matrix with the direct rates, so a single fetch answers
+# USD -> ARS, EUR -> USDT or any other pair.
+
+CROSS_MAX_HOPS = 2
+
+def get_cross_rates(quotes, max_hops=CROSS_MAX_HOPS):
+    pairs = quotes["pairs"]
+    currencies = sorted(set(pair["coin"] for pair in pairs) | set(pair["currency"] for pair in pairs))
+    index = {currency: i for i, currency in enumerate(currencies)}
+    coins = np.array([index[pair["coin"]] for pair in pairs], dtype=np.intp)
+    fiats = np.array([index[pair["currency"]] for pair in pairs], dtype=np.intp)
+    bids = np.array([np.nan if pair["bid"] is None else pair["bid"] for pair in pairs], dtype=np.float64)
+    asks = np.array([np.nan if pair["ask"] is None else pair["ask"] for pair in pairs], dtype=np.float64)
+    commissions = np.array([pair["commission"] for pair in pairs], dtype=np.float64)
+
+    direct = np.zeros((len(currencies), len(currencies)))
+    np.fill_diagonal(direct, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for sources, targets, rates in [(coins, fiats, bids*(1-commissions)), (fiats, coins, (1-commissions)/asks)]:
+            valid = np.isfinite(rates) & (rates > 0)
+            np.maximum.at(direct, (sources[valid], targets[valid]), rates[valid])
+
+    # One more hop through each intermediate currency k in turn, so memory
+    # stays at n x n however many currencies the catalog brings.
+    cross = direct
+    for hop in range(max_hops - 1):
+        extended = cross.copy()
+        for k in range(len(currencies)):
+            np.maximum(extended, cross[:, [k]]*direct[k], out=extended)
+        cross = extended
+    return {"currencies": currencies, "index": index, "direct": direct, "rates": cross}
+
+def get_cross_rate(cross_rates, source, target):
+    # None when there is no way from source to target.
+    if has_key(cross_rates["index"], source) == False or has_key(cross_rates["index"], target) == False:
+        return None
+    rate = float(cross_rates["rates"][cross_rates["index"][source], cross_rates["index"][target]])
+    return rate if rate > 0 else None
+
+def print_cross_rates(cross_rates, currencies):
+    x = prettytable.PrettyTable()
+    x.field_names = ["from \\ to", *currencies]
+    for source in currencies:
+        row = [source]
+        for target in currencies:
+            rate = get_cross_rate(cross_rates, source, target)
+            row.append("-" if rate is None or source == target else format(rate, ".6g"))
+        x.add_row(row)
+    x.align = "r"
+    print(x.get_string())
+
+async def print_cross_rates_async(currencies=None, max_hops=CROSS_MAX_HOPS, client=None):
+    error_log = []
+    requests_res = await get_requests_res(error_log, client)
+    processed_rates = process_all_info(requests_res, error_log)
+    store_processed_rates(processed_rates)
+    cross_rates = get_cross_rates(processed_rates, max_hops)
+    if not currencies:
+        currencies = [currency for currency in MARKET_CURRENCIES if has_key(cross_rates["index"], currency)]
+        currencies = [currency for currency in [CONFIG["base"], CONFIG["quote"]] if currency not in currencies] + currencies
+    print_cross_rates(cross_rates, currencies)
+    for error_msg in error_log:
+        print(error_msg)
+    return cross_rates
+
+#-------------------------------------------------------------------------------
+# Service mode: a small HTTP/JSON server answering from quotes kept in memory.
+# One background task refreshes them every SERVICE_REFRESH_INTERVAL seconds.
+# A query that finds them older than its max_age (SERVICE_MAX_AGE by default)
+# triggers a refresh; concurrent misses wait for the same upstream fetch
+# instead of starting their own.
+#   GET /best?amount=500                     best coin/exchange from the rate matrix
+#   GET /routes?amount=500&k=5&from=&to=     top-k multi-hop routes
+#   GET /cross?amount=1&from=USD&to=ARS      rate from the cross-rate matrix
+#   GET /health                              age of the quotes and last fetch errors
+# from and to default to CONFIG["base"] and CONFIG["quote"]; /best only
+# answers that pair. ?eur= is still accepted for amount.
+
+SERVICE_REFRESH_INTERVAL = 30
+SERVICE_MAX_AGE = 60
+
+def new_service_state():
+    return {"quotes": None, "updated": None, "errors": [], "refreshing": None, "cross": None}
+
+def get_service_cross_rates(state, quotes):
+    # Computed once per refresh, not per /cross request.
+    if state["cross"] is None or state["cross"][0] != state["updated"]:
+        state["cross"] = (state["updated"], get_cross_rates(quotes))
+    return state["cross"][1]
+
+async def refresh_service_quotes(state, client):
+    if state["refreshing"] is not None:
+        # Single flight: someone is already fetching.
+        await state["refreshing"].wait()
+        return
+    state["refreshing"] = trio.Event()
+    try:
+        error_log = []
+        started = time.perf_counter()
+        requests_res = await get_requests_res(error_log, client)
+        # Published only once complete: queries during the order-book fetch
+        # keep getting the previous quotes.
+        quotes = process_all_info(requests_res, error_log)
+        quotes = await add_depth_books(quotes, error_log, client, started)
+        state["quotes"] = quotes
+        state["updated"] = datetime.now(tz=None)
+        state["errors"] = error_log
+        store_processed_rates(quotes)
+        await check_alerts(quotes, client)
+    finally:
+        state["refreshing"].set()
+        state["refreshing"] = None
+
+async def get_service_quotes(state, client, max_age=SERVICE_MAX_AGE):
+    if state["updated"] is None or (datetime.now(tz=None) - state["updated"]).total_seconds() > max_age:
+        await refresh_service_quotes(state, client)
+    return state["quotes"]
+
+async def answer_service_request(state, client, path, query):
+    # Returns (status, JSON-serialisable body).
+    if path == "/health":
+        age = None if state["updated"] is None else (datetime.now(tz=None) - state["updated"]).total_seconds()
+        return 200, {"age_s": age, "errors": state["errors"]}
+    if path not in ["/best", "/routes", "/cross"]:
+        return 404, {"error": "unknown path " + path}
+
+    try:
+        # ?eur= is the name amount had when the base was always EUR.
+        amount = float(query.get("amount", query.get("eur", ["1" if path == "/cross" else None]))[0])
+        max_age = float(query["max_age"][0]) if has_key(query, "max_age") else SERVICE_MAX_AGE
+        top_k = int(query["k"][0]) if has_key(query, "k") else ROUTES_TOP_K
+        source = query["from"][0].upper() if has_key(query, "from") else CONFIG["base"]
+        target = query["to"][0].upper() if has_key(query, "to") else CONFIG["quote"]
+    except (KeyError, ValueError, TypeError):
+        return 400, {"error": "expected ?amount=<amount>, optional max_age, k, from and to"}
+
+    quotes = await get_service_quotes(state, client, max_age)
+    if quotes is None:
+        return 503, {"error": "no quotes fetched yet", "errors": state["errors"]}
+    answer = {"amount": amount, "from": source, "to": target, "updated": state["updated"].isoformat(), "errors": state["errors"]}
+    if path == "/cross":
+        rate = get_cross_rate(get_service_cross_rates(state, quotes), source, target)
+        answer["rate"] = rate
+        answer["result"] = None if rate is None else amount*rate
+    elif path == "/best":
+        if source != CONFIG["base"] or target != CONFIG["quote"]:
+            return 400, {"error": "/best only answers " + CONFIG["base"] + " -> " + CONFIG["quote"] + "; use /routes or /cross"}
+        route = get_best_routes(get_rates_matrix([amount], quotes))[0]
+        answer["best"] = None if route is None else {"coin": route[0], "exchange": route[1], "rate": route[2]}
+    else:
+        routes = find_routes(get_rate_graph(quotes), amount, source, target, top_k)
+        answer["routes"] = [{"route": format_route(route["steps"]), "result": route["amount"], "rate": route["rate"]} for route in routes]
+    return 200, answer
+
+async def handle_service_connection(stream, state, client):
+    async with stream:
+        request = b""
+        with trio.move_on_after(10):
+            while b"\r\n\r\n" not in request and len(request) < 65536:
+                chunk = await stream.receive_some(4096)
+                if not chunk:
+                    return
+                request += chunk
+        request_line = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+        if len(request_line) != 3:
+            status, answer = 400, {"error": "bad request"}
+        elif request_line[0] != "GET":
+            status, answer = 405, {"error": "only GET is supported"}
+        else:
+            url = urllib.parse.urlsplit(request_line[1])
+            try:
+                status, answer = await answer_service_request(state, client, url.path, urllib.parse.parse_qs(url.query))
+            except Exception as e:
+                status, answer = 500, {"error": str(e)}
+        body = json.dumps(answer).encode("utf-8")
+        head = "HTTP/1.1 " + str(status) + " " + http.HTTPStatus(status).phrase + "\r\n"
+        head += "Content-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n"
+        try:
+            await stream.send_all(head.encode("latin-1") + body)
+        except trio.BrokenResourceError:
+            pass
+
+async def run_service(host="127.0.0.1", port=8080, refresh_interval=SERVICE_REFRESH_INTERVAL, task_status=None):
+    # task_status defaults to None rather than trio.TASK_STATUS_IGNORED so
+    # defining this function doesn't import trio.
+    if task_status is None:
+        task_status = trio.TASK_STATUS_IGNORED
+    state = new_service_state()
+    async with get_http_client() as client:
+
+        async def refresher():
+            while True:
+                try:
+                    await refresh_service_quotes(state, client)
+                except Exception as e:
+                    state["errors"] = ["Error while refreshing quotes: " + str(e)]
+                await trio.sleep(refresh_interval)
+
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(refresher)
+            listeners = await nursery.start(functools.partial(trio.serve_tcp, host=host), lambda stream: handle_service_connection(stream, state, client), port)
+            task_status.started(listeners)
+            print("Serving on http://" + host + ":" + str(listeners[0].socket.getsockname()[1]) + " (/best, /routes, /cross, /health; ?amount=, from=, to=)")
+
 #-------------------------------------------------------------------------------
+# Instrumentation. Every check collects
+#   metrics["exchanges"][exchange]: connect_s, tls_s, response_s (time to the
+#       response headers), total_s, bytes, status and parse_s
+#   metrics["compute_s"], metrics["render_s"]: table computation and printing
+# Connection times come from httpx's trace events; they are 0 when a pooled
+# connection was reused, and connect_s includes the DNS lookup, which httpx
+# doesn't report separately.
+
+def new_metrics():
+    return {"timestamp": datetime.now(tz=None).isoformat(), "exchanges": {}}
+
+def get_request_metrics(trace_events, start, end, res):
+
+    def elapsed(prefix_started, prefix_complete):
+        started = [t for name, t in trace_events.items() if name.endswith(prefix_started)]
+        complete = [t for name, t in trace_events.items() if name.endswith(prefix_complete)]
+        if len(started) == 0 or len(complete) == 0:
+            return 0
+        return min(complete) - min(started)
+
+    headers_received = [t for name, t in trace_events.items() if name.endswith("receive_response_headers.complete")]
+    return {
+        "connect_s": elapsed("connect_tcp.started", "connect_tcp.complete"),
+        "tls_s": elapsed("start_tls.started", "start_tls.complete"),
+        "response_s": (min(headers_received) if len(headers_received) > 0 else end) - start,
+        "total_s": end - start,
+        "bytes": len(res.content),
+        "wire_bytes": res.num_bytes_downloaded, # compressed size
+        "status": res.status_code
+    }
+
+def get_prometheus_text(metrics):
+    lines = [
+        "# HELP crypto_rates_request_seconds Time spent on each phase of the last request to an exchange.",
+        "# TYPE crypto_rates_request_seconds gauge"
+    ]
+    for exchange, values in metrics["exchanges"].items():
+        for phase in ["connect", "tls", "response", "total", "parse"]:
+            if has_key(values, phase + "_s"):
+                lines.append("crypto_rates_request_seconds{exchange=\"" + exchange + "\",phase=\"" + phase + "\"} " + repr(values[phase + "_s"]))
+    lines.append("# HELP crypto_rates_response_bytes Size of the last response body of an exchange.")
+    lines.append("# TYPE crypto_rates_response_bytes gauge")
+    for exchange, values in metrics["exchanges"].items():
+        if has_key(values, "bytes"):
+            lines.append("crypto_rates_response_bytes{exchange=\"" + exchange + "\",encoding=\"identity\"} " + str(values["bytes"]))
+            lines.append("crypto_rates_response_bytes{exchange=\"" + exchange + "\",encoding=\"wire\"} " + str(values["wire_bytes"]))
+    lines.append("# HELP crypto_rates_check_seconds Time spent computing and rendering the last table.")
+    lines.append("# TYPE crypto_rates_check_seconds gauge")
+    for phase in ["compute", "render"]:
+        if has_key(metrics, phase + "_s"):
+            lines.append("crypto_rates_check_seconds{phase=\"" + phase + "\"} " + repr(metrics[phase + "_s"]))
+    return "\n".join(lines) + "\n"
+
+def print_metrics(metrics):
+    x = prettytable.PrettyTable()
+    x.field_names = ["exchange", "status", "connect ms", "tls ms", "response ms", "total ms", "bytes", "wire bytes", "parse ms"]
+    for exchange, values in metrics["exchanges"].items():
+        x.add_row([exchange, values.get("status", "-"), *[round(values[key]*1000, 2) if has_key(values, key) else "-" for key in ["connect_s", "tls_s", "response_s", "total_s"]],
+            values.get("bytes", "-"), values.get("wire_bytes", "-"), round(values["parse_s"]*1000, 3) if has_key(values, "parse_s") else "-"])
+    x.align = "r"
+    out = get_message_stream()
+    print(x.get_string(), file=out)
+    print("Table computation: " + str(round(metrics.get("compute_s", 0)*1000, 3)) + " ms, render: " + str(round(metrics.get("render_s", 0)*1000, 3)) + " ms", file=out)
+    print("", file=out)
+
+def report_metrics(metrics):
+    if CONFIG["metrics_log"] is not None:
+        with open(CONFIG["metrics_log"], "a", encoding="utf-8") as f:
+            f.write(json.dumps(metrics) + "\n")
+    if CONFIG["metrics_prom"] is not None:
+        # Written whole and renamed, so a scraper never reads half a file.
+        with open(CONFIG["metrics_prom"] + ".tmp", "w", encoding="utf-8") as f:
+            f.write(get_prometheus_text(metrics))
+        os.replace(CONFIG["metrics_prom"] + ".tmp", CONFIG["metrics_prom"])
+    if CONFIG["profile"]:
+        print_metrics(metrics)
+
+#-------------------------------------------------------------------------------
+# Time-series store. Append-only and columnar: one file per field, all with
+# fixed-width values, so record i is at the same position in every column.
+# Coins and exchanges are stored as small ids; the names live in names.json.
+# Records are appended in time order, so time ranges are found by bisecting
+# the memory-mapped timestamp column without reading the rest of the file.
+
+STORE_COLUMNS = {
+    "timestamp": "<i8", # milliseconds since the epoch
+    "coin": "<u2",
+    "exchange": "<u2",
+    "side": "u1",
+    "price": "<f8"
+}
+STORE_SIDES = {"buy": 0, "sell": 1}
+BUY_EXCHANGE = "bit2me"
+
+def load_store_names(directory):
+    file_path = os.path.join(directory, "names.json")
+    if os.path.exists(file_path):
+        with open(file_path, encoding="utf-8") as f:
+            return json.load(f)
+    return {"coin": [], "exchange": []}
+
+def get_store_id(names, ids, kind, name):
+    # ids: {kind: {name: id}}, built once per append from names.
+    if has_key(ids[kind], name) == False:
+        ids[kind][name] = len(names[kind])
+        names[kind].append(name)
+    return ids[kind][name]
+
+def get_store_records(processed_rates, names, timestamp):
+    records = {column: [] for column in STORE_COLUMNS}
+    ids = {kind: {name: i for i, name in enumerate(names[kind])} for kind in names}
+
+    def add(coin, exchange, side, price):
+        records["timestamp"].append(timestamp)
+        records["coin"].append(get_store_id(names, ids, "coin", coin))
+        records["exchange"].append(get_store_id(names, ids, "exchange", exchange))
+        records["side"].append(STORE_SIDES[side])
+        records["price"].append(float(price))
+
+    q = get_quote_arrays(processed_rates)
+    for c in np.flatnonzero(q["has_buy"]):
+        add(q["coins"][c], BUY_EXCHANGE, "buy", q["buy"][c])
+    for c, e in zip(*np.nonzero(q["has_sell"])):
+        add(q["coins"][c], q["exchanges"][e], "sell", q["sell"][c, e])
+    return records
+
+def append_to_store(directory, processed_rates, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz=None)
+    os.makedirs(directory, exist_ok=True)
+    names = load_store_names(directory)
+    records = get_store_records(processed_rates, names, int(timestamp.timestamp()*1000))
+
+    # Names first: a record must never point to an unknown id.
+    with open(os.path.join(directory, "names.json.tmp"), "w", encoding="utf-8") as f:
+        json.dump(names, f)
+    os.replace(os.path.join(directory, "names.json.tmp"), os.path.join(directory, "names.json"))
+    for column, dtype in STORE_COLUMNS.items():
+        with open(os.path.join(directory, column + ".bin"), "ab") as f:
+            f.write(np.asarray(records[column], dtype=dtype).tobytes())
+
+def open_store(directory):
+    columns = {}
+    for column, dtype in STORE_COLUMNS.items():
+        file_path = os.path.join(directory, column + ".bin")
+        if os.path.exists(file_path) == False or os.path.getsize(file_path) == 0:
+            columns[column] = np.zeros(0, dtype=dtype)
+        else:
+            columns[column] = np.memmap(file_path, dtype=dtype, mode="r")
+    # An interrupted append can leave some columns longer than others.
+    length = min(len(values) for values in columns.values())
+    return {column: values[:length] for column, values in columns.items()}, load_store_names(directory)
+
+def query_store(directory, coin=None, exchange=None, side=None, start=None, end=None):
+
+    # Records between start and end (datetimes, both optional) matching the
+    # given coin, exchange and side, as a dict of NumPy arrays.
+
+    columns, names = open_store(directory)
+    timestamps = columns["timestamp"]
+    first = 0 if start is None else int(np.searchsorted(timestamps, int(start.timestamp()*1000), side="left"))
+    last = len(timestamps) if end is None else int(np.searchsorted(timestamps, int(end.timestamp()*1000), side="right"))
+
+    selected = np.ones(last - first, dtype=bool)
+    for column, name in [("coin", coin), ("exchange", exchange)]:
+        if name is not None:
+            if name not in names[column]:
+                return {column: np.zeros(0, dtype=dtype) for column, dtype in STORE_COLUMNS.items()}, names
+            selected &= columns[column][first:last] == names[column].index(name)
+    if side is not None:
+        selected &= columns["side"][first:last] == STORE_SIDES[side]
+
+    return {column: np.asarray(values[first:last][selected]) for column, values in columns.items()}, names
+
+def get_best_stored_price(directory, coin, exchange, side="sell", start=None, end=None):
+    records, names = query_store(directory, coin, exchange, side, start, end)
+    if len(records["price"]) == 0:
+        return None
+    i = int(np.argmax(records["price"])) if side == "sell" else int(np.argmin(records["price"]))
+    return float(records["price"][i]), datetime.fromtimestamp(records["timestamp"][i]/1000)
+
+def store_processed_rates(processed_rates, timestamp=None):
+    if CONFIG["store_dir"] is not None:
+        append_to_store(CONFIG["store_dir"], processed_rates, timestamp)
+
+def save_last_rates(processed_rates, timestamp=None):
+    # Only rates that can fill a table are worth starting from.
+    if CONFIG["warm_start"] is not None and len(get_usable_indexes(processed_rates)[0]) > 0:
+        try:
+            save_warm_start(processed_rates, CONFIG["warm_start"], timestamp)
+        except OSError as e:
+            # A read-only install only loses the warm start, not the check;
+            # warned once, then no longer tried.
+            print("Could not save the last known rates to " + CONFIG["warm_start"] + ": " + str(e), file=sys.stderr)
+            CONFIG["warm_start"] = None
+
+#-------------------------------------------------------------------------------
+# Warm start. The last processed rates of a check are saved as a compressed
+# .npz of the filled quote arrays and pairs. The next session starts fetching
+# fresh rates right away, shows the saved ones as soon as the first amount is
+# entered, marked with their age, and replaces them as fresh answers arrive
+# (see check_rates_progressive). Exchanges that don't answer keep their saved
+# rates, marked stale.
+
+WARM_START_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "last_rates.npz")
+warm_start = {"quotes": None, "timestamp": None}
+
+def save_warm_start(quotes, path, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz=None)
+    q = get_quote_arrays(quotes)
+    pairs = quotes["pairs"]
+    arrays = {
+        "timestamp": np.array(int(timestamp.timestamp()*1000)),
+        "base": np.array(CONFIG["base"]),
+        "quote": np.array(CONFIG["quote"]),
+        "coins": np.array(q["coins"], dtype=str),
+        "exchanges": np.array(q["exchanges"], dtype=str),
+        "pair_coin": np.array([pair["coin"] for pair in pairs], dtype=str),
+        "pair_currency": np.array([pair["currency"] for pair in pairs], dtype=str),
+        "pair_exchange": np.array([pair["exchange"] for pair in pairs], dtype=str)
+    }
+    for field in ["buy", "network_fee", "has_buy", "sell", "commission", "has_sell"]:
+        arrays[field] = q[field]
+    for field in ["bid", "ask", "commission", "network_fee"]:
+        arrays["pair_" + field] = np.array([np.nan if pair[field] is None else pair[field] for pair in pairs], dtype=np.float64)
+    # Written whole and renamed, so a crash never leaves half a file.
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+def load_warm_start(path):
+    # (quotes, datetime) or None when there is no usable file.
+    if os.path.exists(path) == False:
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            if str(arrays["base"]) != CONFIG["base"] or str(arrays["quote"]) != CONFIG["quote"]:
+                return None
+            coins = arrays["coins"].tolist()
+            exchanges = arrays["exchanges"].tolist()
+            quotes = new_quotes(max(len(coins), 1), max(len(exchanges), 1))
+            for coin in coins:
+                get_coin_index(quotes, coin)
+            for exchange in exchanges:
+                get_exchange_index(quotes, exchange)
+            for field in ["buy", "network_fee", "has_buy"]:
+                quotes[field][:len(coins)] = arrays[field]
+            for field in ["sell", "commission", "has_sell"]:
+                quotes[field][:len(coins), :len(exchanges)] = arrays[field]
+            for i in range(len(arrays["pair_coin"])):
+                bid, ask = float(arrays["pair_bid"][i]), float(arrays["pair_ask"][i])
+                add_pair_quote(quotes, str(arrays["pair_coin"][i]), str(arrays["pair_currency"][i]), str(arrays["pair_exchange"][i]),
+                    None if math.isnan(bid) else bid, None if math.isnan(ask) else ask, arrays["pair_commission"][i], arrays["pair_network_fee"][i])
+            timestamp = datetime.fromtimestamp(int(arrays["timestamp"])/1000)
+    except (OSError, KeyError, ValueError) as e:
+        print("Ignoring the last known rates in " + path + ": " + str(e), file=get_message_stream())
+        return None
+    return quotes, timestamp
+
+def take_warm_start():
+    # The saved rates are only shown once, by the first check of a session.
+    if warm_start["quotes"] is None:
+        return None
+    warm = (warm_start["quotes"], warm_start["timestamp"])
+    warm_start["quotes"] = None
+    return warm
+
+# The fetch started by run_session before the first amount is entered, joined
+# by the first check unless it is older than STALE_MAX_AGE by then.
+prefetch = {"fetch": None}
+
+async def prefetch_rates(client=None):
+    fetch = {"timestamp": datetime.now(tz=None), "done": trio.Event(), "requests_res": None, "responses": {}, "on_response": None,
+        "error_log": [], "stale": {}, "missing": [], "metrics": new_metrics()}
+    prefetch["fetch"] = fetch
+
+    def on_response(exchange, raw):
+        fetch["responses"][exchange] = raw
+        if fetch["on_response"] is not None:
+            fetch["on_response"](exchange, raw)
+
+    try:
+        fetch["requests_res"] = await get_requests_res(fetch["error_log"], client, fetch["stale"], fetch["missing"], on_response, fetch["metrics"])
+    finally:
+        fetch["done"].set()
+
+def take_prefetch():
+    # The prefetch, only once and only while its rates are fresh enough.
+    fetch = prefetch["fetch"]
+    prefetch["fetch"] = None
+    if fetch is None or (datetime.now(tz=None) - fetch["timestamp"]).total_seconds() > STALE_MAX_AGE:
+        return None
+    return fetch
+
+async def join_prefetch(fetch, error_log, stale=None, missing=None, on_response=None, metrics=None):
+    # requests_res of fetch, filling the arguments as get_requests_res would.
+    # Answers that already arrived are passed to on_response first.
+    if on_response is not None:
+        for exchange, raw in list(fetch["responses"].items()):
+            on_response(exchange, raw)
+        fetch["on_response"] = on_response
+    await fetch["done"].wait()
+    error_log.extend(fetch["error_log"])
+    if stale is not None:
+        stale.update(fetch["stale"])
+    if missing is not None:
+        missing.extend(fetch["missing"])
+    if metrics is not None:
+        metrics.update(fetch["metrics"])
+    return fetch["requests_res"]
+
+def keep_warm_rates(processed_rates, warm, stale, missing):
+    # Fresh quotes plus the warm ones of the exchanges in missing, which move
+    # to stale with the warm timestamp. Sell quotes and pairs are kept per
+    # exchange; an exchange without a sell column (bit2me) only quotes buys,
+    # and then the coins without a fresh buy keep their warm one.
+    quotes, timestamp = warm
+    fresh_buys = set(coin for c, coin in enumerate(processed_rates["coins"]) if processed_rates["has_buy"][c])
+    old = new_quotes()
+    for label in list(missing):
+        exchange = label.split("#", 1)[0]
+        e = quotes["exchange_index"].get(exchange)
+        kept = False
+        for c, coin in enumerate(quotes["coins"]):
+            if e is not None and quotes["has_sell"][c, e]:
+                set_sell_quote(old, coin, exchange, quotes["sell"][c, e], quotes["commission"][c, e])
+                kept = True
+            elif e is None and quotes["has_buy"][c] and coin not in fresh_buys:
+                set_buy_quote(old, coin, quotes["buy"][c], quotes["network_fee"][c])
+                kept = True
+        for pair in quotes["pairs"]:
+            if pair["exchange"] == exchange and pair not in old["pairs"]:
+                old["pairs"].append(pair)
+                kept = True
+        if kept:
+            missing.remove(label)
+            stale[label] = timestamp
+    if len(old["coins"]) == 0 and len(old["pairs"]) == 0:
+        return processed_rates
+    merge_quotes(old, processed_rates)
+    return old
+
+def format_age(timestamp):
+    seconds = (datetime.now(tz=None) - timestamp).total_seconds()
+    if seconds < 120:
+        return str(int(seconds)) + " s"
+    if seconds < 7200:
+        return str(int(seconds // 60)) + " min"
+    if seconds < 172800:
+        return str(int(seconds // 3600)) + " h"
+    return str(int(seconds // 86400)) + " days"
+
+def print_best_stored_price(directory, coin, exchange, side="sell", days=7):
+    start = datetime.now(tz=None) - timedelta(days=days)
+    best = get_best_stored_price(directory, coin, exchange, side, start)
+    if best is None:
+        print("No " + side + " prices stored for " + coin + " on " + exchange + " in the last " + str(days) + " days")
+    else:
+        price, timestamp = best
+        print("Best " + side + " price for " + coin + " on " + exchange + " in the last " + str(days) + " days: " + str(price) + " (" + timestamp.strftime("%Y-%m-%d %H:%M:%S") + ")")
+
+#-------------------------------------------------------------------------------
+# Machine-readable output. Instead of the table, every sellable cell of a check
+# is written to stdout as one record, as soon as it is computed: JSON lines,
+# CSV (header once) or an Arrow IPC stream (one record batch per check, needs
+# pyarrow). Errors go to stderr.
+
+RECORD_FORMATS = ["jsonl", "csv", "arrow"]
+RECORD_FIELDS = ["timestamp", "base", "amount", "quote", "coin", "exchange", "coins_transfered", "rate", "stale"]
+record_writers = {}
+
+def get_record_writer(output_format):
+    writer = record_writers.get(output_format)
+    if writer is None:
+        writer = {"format": output_format, "stream": sys.stdout}
+        if output_format == "csv":
+            writer["csv"] = csv.writer(sys.stdout, lineterminator="\n")
+            writer["csv"].writerow(RECORD_FIELDS)
+        elif output_format == "arrow":
+            import pyarrow # only needed for --output arrow
+            writer["pyarrow"] = pyarrow
+            writer["schema"] = pyarrow.schema([
+                ("timestamp", pyarrow.string()),
+                ("base", pyarrow.string()),
+                ("amount", pyarrow.float64()),
+                ("quote", pyarrow.string()),
+                ("coin", pyarrow.string()),
+                ("exchange", pyarrow.string()),
+                ("coins_transfered", pyarrow.float64()),
+                ("rate", pyarrow.float64()),
+                ("stale", pyarrow.bool_())
+            ])
+            writer["stream"] = pyarrow.ipc.new_stream(sys.stdout.buffer, writer["schema"])
+        record_writers[output_format] = writer
+    return writer
+
+def close_record_writers():
+    for writer in record_writers.values():
+        if writer["format"] == "arrow":
+            writer["stream"].close()
+        sys.stdout.flush()
+    record_writers.clear()
+
+def get_rate_records(amounts, processed_rates, timestamp, stale={}):
+    # One record per amount and sellable cell, from the batch rate math.
+    rates_matrix = get_rates_matrix(amounts, processed_rates)
+    for a, amount in enumerate(rates_matrix["amounts"]):
+        for c, coin in enumerate(rates_matrix["coins"]):
+            for e, exchange in enumerate(rates_matrix["exchanges"]):
+                rate = rates_matrix["rates"][a, c, e]
+                if np.isnan(rate):
+                    continue
+                yield [timestamp, CONFIG["base"], float(amount), CONFIG["quote"], coin, exchange, float(rates_matrix["coins_transfered"][a, c]), float(rate), has_key(stale, exchange)]
+
+def write_rate_records(records, output_format, error_log=[]):
+    writer = get_record_writer(output_format)
+    if output_format == "jsonl":
+        for record in records:
+            writer["stream"].write(json.dumps(dict(zip(RECORD_FIELDS, record))) + "\n")
+    elif output_format == "csv":
+        for record in records:
+            writer["csv"].writerow(record)
+    else:
+        columns = [[] for field in RECORD_FIELDS]
+        for record in records:
+            for column, value in zip(columns, record):
+                column.append(value)
+        arrays = [writer["pyarrow"].array(column, type=field.type) for column, field in zip(columns, writer["schema"])]
+        writer["stream"].write_batch(writer["pyarrow"].record_batch(arrays, schema=writer["schema"]))
+    if output_format != "arrow":
+        writer["stream"].flush()
+    else:
+        sys.stdout.buffer.flush()
+    for error_msg in error_log:
+        print(error_msg, file=sys.stderr)
+
+#-------------------------------------------------------------------------------
+# Threshold alerts. Rules are loaded from a JSON file:
+#   [{"coin": "BTC", "exchange": "buenbit", "amount": 500, "above": 180}, ...]
+# ("below" instead of "above" for falling rates, optional "id"). They are
+# indexed by (coin, exchange, amount of CONFIG["base"]), with the thresholds of each
+# direction sorted, so on every refresh only the rules whose threshold lies
+# between the previous rate and the new one are found, by bisecting. A rule
+# fires when the rate crosses it (or already is past it on the first
+# refresh) and is handed to the configured sink.
+
+alert_rules = {"index": {}, "amounts": []}
+# Rate of every indexed (coin, exchange, amount) at the last refresh.
+alert_rates = {}
+
+def check_alert_rule(i, rule):
+    # ValueError naming the rule (by its position in the file) and what is
+    # wrong with it.
+    if isinstance(rule, dict) == False:
+        raise ValueError("alert rule " + str(i) + " is not an object")
+    for key in ["coin", "exchange"]:
+        if rule.get(key) is None:
+            raise ValueError("alert rule " + str(i) + " has no '" + key + "'")
+    if rule.get("amount", rule.get("EUR")) is None:
+        raise ValueError("alert rule " + str(i) + " has no 'amount' (or 'EUR')")
+    if rule.get("above") is None and rule.get("below") is None:
+        raise ValueError("alert rule " + str(i) + " has neither 'above' nor 'below'")
+    for key in ["amount", "EUR", "above", "below"]:
+        if rule.get(key) is not None:
+            try:
+                float(rule[key])
+            except (TypeError, ValueError):
+                raise ValueError("alert rule " + str(i) + ": '" + key + "' is not a number")
+
+def load_alert_rules(path):
+    # Raises ValueError for a file or rule that can't be used.
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)
+    if isinstance(rules, list) == False:
+        raise ValueError("expected a list of alert rules")
+    for i, rule in enumerate(rules):
+        check_alert_rule(i, rule)
+    index = {}
+    for i, rule in enumerate(rules):
+        key = (str(rule["coin"]).upper(), rule["exchange"], float(rule.get("amount", rule.get("EUR"))))
+        entry = index.setdefault(key, {"above": [], "below": []})
+        for direction in ["above", "below"]:
+            if rule.get(direction) is not None:
+                entry[direction].append((float(rule[direction]), rule.get("id", i)))
+    for entry in index.values():
+        for direction in ["above", "below"]:
+            entry[direction].sort(key=lambda threshold: threshold[0])
+            entry[direction + "_thresholds"] = [threshold for threshold, rule_id in entry[direction]]
+    alert_rules["index"] = index
+    alert_rules["amounts"] = sorted(set(key[2] for key in index))
+    alert_rates.clear()
+    return len(rules)
+
+def get_crossed_rules(entry, previous, rate):
+    # (direction, threshold, rule id) of every rule crossed going from
+    # previous (None on the first refresh) to rate.
+    crossed = []
+    thresholds = entry["above_thresholds"]
+    start = 0 if previous is None else bisect.bisect_right(thresholds, previous)
+    end = bisect.bisect_right(thresholds, rate)
+    crossed.extend(("above", *rule) for rule in entry["above"][start:end])
+    thresholds = entry["below_thresholds"]
+    start = bisect.bisect_left(thresholds, rate)
+    end = len(thresholds) if previous is None else bisect.bisect_left(thresholds, previous)
+    crossed.extend(("below", *rule) for rule in entry["below"][start:end])
+    return crossed
+
+def evaluate_alerts(processed_rates, timestamp):
+    alerts = []
+    if len(alert_rules["index"]) == 0:
+        return alerts
+    rates_matrix = get_rates_matrix(alert_rules["amounts"], processed_rates)
+    coin_columns = {coin: c for c, coin in enumerate(rates_matrix["coins"])}
+    exchange_columns = {exchange: e for e, exchange in enumerate(rates_matrix["exchanges"])}
+    amount_rows = {amount: a for a, amount in enumerate(alert_rules["amounts"])}
+    for key, entry in alert_rules["index"].items():
+        coin, exchange, amount = key
+        if has_key(coin_columns, coin) == False or has_key(exchange_columns, exchange) == False:
+            continue
+        rate = float(rates_matrix["rates"][amount_rows[amount], coin_columns[coin], exchange_columns[exchange]])
+        previous = alert_rates.get(key)
+        if math.isnan(rate) or rate == previous:
+            continue
+        alert_rates[key] = rate
+        for direction, threshold, rule_id in get_crossed_rules(entry, previous, rate):
+            alerts.append({
+                "rule": rule_id,
+                "timestamp": timestamp,
+                "coin": coin,
+                "exchange": exchange,
+                "amount": amount,
+                "direction": direction,
+                "threshold": threshold,
+                "rate": rate
+            })
+    return alerts
+
+def format_alert(alert):
+    return (alert["coin"] + " via " + alert["exchange"] + " for " + str(alert["amount"]) + " " + CONFIG["base"] + ": " + str(round(alert["rate"], 2)) + " " + CONFIG["quote"] + "/" + CONFIG["base"] + ", "
+        + ("≥ " if alert["direction"] == "above" else "≤ ") + str(alert["threshold"]) + " (rule " + str(alert["rule"]) + ")")
+
+async def send_alerts_stderr(alerts, target, client):
+    for alert in alerts:
+        print("Alert: " + format_alert(alert), file=sys.stderr)
+
+async def send_alerts_file(alerts, target, client):
+    with open(target, "a", encoding="utf-8") as f:
+        for alert in alerts:
+            f.write(json.dumps(alert) + "\n")
+
+async def send_alerts_webhook(alerts, target, client):
+    res = await client.post(target, json=alerts)
+    res.raise_for_status()
+
+# Sinks are called as sink(alerts, target, client); --alert-sink NAME[:TARGET].
+ALERT_SINKS = {
+    "stderr": send_alerts_stderr,
+    "file": send_alerts_file,
+    "webhook": send_alerts_webhook
+}
+
+async def check_alerts(processed_rates, client=None):
+    alerts = evaluate_alerts(processed_rates, datetime.now(tz=None).strftime("%Y-%m-%d %H:%M:%S"))
+    if len(alerts) == 0:
+        return
+    sink, target = CONFIG["alert_sink"]
+    try:
+        if client is None:
+            async with httpx.AsyncClient() as client:
+                await ALERT_SINKS[sink](alerts, target, client)
+        else:
+            await ALERT_SINKS[sink](alerts, target, client)
+    except Exception as e:
+        print("Error while sending " + str(len(alerts)) + " alerts to '" + sink + "': " + str(e), file=sys.stderr)
+
+#-------------------------------------------------------------------------------
+# Watch mode: every exchange is polled on its own interval and only the cells
+# whose inputs changed are recomputed and only the rows holding them redrawn.
+
+AMOUNT_ROW = "Sell at ↓"
+
+def get_watch_table(base_amount, processed_rates, previous=None):
+
+    # Cells come from get_rates_matrix; a row is redrawn when one of its
+    # values changed.
+    rates_matrix = get_rates_matrix([base_amount], processed_rates)
+    coins = rates_matrix["coins"]
+    exchanges = rates_matrix["exchanges"]
+    full_redraw = previous is None or previous["coins"] != coins or previous["exchanges"] != exchanges
+
+    inputs = {}
+    cells = {}
+    changed_rows = []
+
+    def set_cell(row, coin, cell_inputs, compute):
+        key = (row, coin)
+        inputs[key] = cell_inputs
+        if full_redraw == False and previous["inputs"][key] == cell_inputs:
+            cells[key] = previous["cells"][key]
+        else:
+            cells[key] = compute()
+            if row not in changed_rows:
+                changed_rows.append(row)
+
+    for c, coin in enumerate(coins):
+        coins_transfered = float(rates_matrix["coins_transfered"][0, c])
+        set_cell(AMOUNT_ROW, coin, coins_transfered, lambda: format_coins_transfered(coins_transfered))
+        for e, exchange in enumerate(exchanges):
+            rate = float(rates_matrix["rates"][0, c, e])
+            if math.isnan(rate) == False:
+                set_cell(exchange, coin, rate, lambda: format_rate(rate))
+            else:
+                set_cell(exchange, coin, None, lambda: "-")
+
+    return {
+        "coins": coins,
+        "exchanges": exchanges,
+        "inputs": inputs,
+        "cells": cells,
+        "changed_rows": changed_rows,
+        "full_redraw": full_redraw
+    }
+
+def get_watch_lines(table):
+
+    # Same layout as print_rates_table. Returns the lines and the line index of
+    # every redrawable row.
+
+    first_width = max([len(AMOUNT_ROW), COL_WIDTH] + [len(exchange) for exchange in table["exchanges"]])
+    widths = [first_width] + [COL_WIDTH for coin in table["coins"]]
+
+    def format_line(values):
+        return "| " + " | ".join(str(value).rjust(width) for value, width in zip(values, widths)) + " |"
+
+    border = "+" + "+".join("-"*(width + 2) for width in widths) + "+"
+    lines = [
+        border,
+        format_line(["", *["b2mn" for coin in table["coins"]]]),
+        format_line(["", *table["coins"]])
+    ]
+    row_lines = {}
+    for row in [AMOUNT_ROW, None, *table["exchanges"]]:
+        if row is None:
+            lines.append(format_line(["-"*width for width in widths]))
+            continue
+        row_lines[row] = len(lines)
+        lines.append(format_line([row, *[table["cells"][(row, coin)] for coin in table["coins"]]]))
+    lines.append(border)
+    return lines, row_lines
+
+def draw_watch_table(table, status, out=sys.stdout):
+    lines, row_lines = get_watch_lines(table)
+    lines.append(status)
+    if table["full_redraw"] or out.isatty() == False:
+        if out.isatty():
+            out.write("\x1b[2J\x1b[H")
+        out.write("\n".join(lines) + "\n")
+    else:
+        # The cursor sits below the status line: move up to each changed row,
+        # rewrite it and come back.
+        for i in [row_lines[row] for row in table["changed_rows"]] + [len(lines) - 1]:
+            up = len(lines) - i
+            out.write("\x1b[" + str(up) + "A\r" + lines[i] + "\x1b[K\x1b[" + str(up) + "B\r")
+    out.flush()
+
+def parse_watch_intervals(values):
+    intervals = dict(WATCH_INTERVALS)
+    default_interval = WATCH_DEFAULT_INTERVAL
+    for value in values or []:
+        if "=" in value:
+            exchange, seconds = value.rsplit("=", 1)
+            intervals[exchange] = float(seconds)
+        else:
+            default_interval = float(value)
+    return intervals, default_interval
+
+async def watch_rates(base_amount, intervals=WATCH_INTERVALS, default_interval=WATCH_DEFAULT_INTERVAL, client=None):
+
+    if CONFIG["endpoints"] is None and EXCHANGES["bit2me_new"]["enabled"]:
+        await update_bit2me_catalog([], client)
+    endpoints = CONFIG["endpoints"] if CONFIG["endpoints"] is not None else get_all_endpoints()
+    requests_res = {}
+    state = {"table": None, "errors": {}}
+
+    def redraw():
+        error_log = []
+        processed_rates = process_all_info(requests_res, error_log)
+        store_processed_rates(processed_rates)
+        table = get_watch_table(base_amount, processed_rates, state["table"])
+        state["table"] = table
+        if CONFIG["output"] != "table":
+            if table["full_redraw"] or len(table["changed_rows"]) > 0:
+                timestamp = datetime.now(tz=None).strftime("%Y-%m-%d %H:%M:%S")
+                write_rate_records(get_rate_records([base_amount], processed_rates, timestamp), CONFIG["output"], error_log)
+        elif table["full_redraw"] or len(table["changed_rows"]) > 0:
+            status = "Updated: " + datetime.now(tz=None).strftime("%Y-%m-%d %H:%M:%S")
+            errors = error_log + list(state["errors"].values())
+            if len(errors) > 0:
+                status += " | " + " | ".join(errors)
+            draw_watch_table(table, status)
+        return processed_rates
+
+    async def poll(exchange, url, interval):
+        while True:
+            error_log = []
+            if CONFIG["endpoints"] is None:
+                url = get_exchange_urls(get_endpoint_exchange(exchange), EXCHANGES[get_endpoint_exchange(exchange)]).get(exchange, url)
+            res = await run_requests({exchange: url}, error_log, client, CONFIG["deadlines"], default_deadline=CONFIG["default_deadline"])
+            if len(error_log) > 0:
+                state["errors"][exchange] = error_log[-1]
+            elif has_key(state["errors"], exchange):
+                del state["errors"][exchange]
+            if has_key(res, exchange) and res[exchange] != requests_res.get(exchange):
+                requests_res[exchange] = res[exchange]
+                if CONFIG["record_dir"] is not None:
+                    save_snapshot(requests_res, CONFIG["record_dir"])
+                await check_alerts(redraw(), client)
+            await trio.sleep(interval)
+
+    async with trio.open_nursery() as nursery:
+        for exchange, url in endpoints.items():
+            nursery.start_soon(poll, exchange, url, intervals.get(exchange, intervals.get(get_endpoint_exchange(exchange), default_interval)))
+
+async def run_watch(base_amount, intervals=WATCH_INTERVALS, default_interval=WATCH_DEFAULT_INTERVAL):
+    async with get_http_client() as client:
+        await watch_rates(base_amount, intervals, default_interval, client)
+
+#-------------------------------------------------------------------------------
+# Offline benchmarks, run against the replay server (see --benchmark).
+
+BENCHMARK_WARMUP_RUNS = 2 # untimed runs before each benchmark
+
+def get_timing_summary(timings):
+    timings = sorted(timings)
+    return {
+        "runs": len(timings),
+        "median_ms": statistics.median(timings)*1000,
+        "p95_ms": timings[min(len(timings)-1, int(len(timings)*0.95))]*1000,
+        "max_ms": timings[-1]*1000
+    }
+
+def benchmark_parse(snapshots, runs, warmup=BENCHMARK_WARMUP_RUNS):
+    timings = []
+    # Parse from bytes, as run_requests returns them.
+    responses = [{exchange: raw.encode("utf-8") for exchange, raw in snapshot["responses"].items()} for snapshot in snapshots]
+    # The first runs pay for the lazy imports (numpy, orjson); not timed.
+    for i in range(-warmup, runs):
+        requests_res = responses[i % len(responses)]
+        parsed_quotes.clear()
+        last_processed["sources"] = None
+        start = time.perf_counter()
+        process_all_info(requests_res, [])
+        if i >= 0:
+            timings.append(time.perf_counter() - start)
+    return timings
+
+async def benchmark_checks(base_amount, runs, concurrency=1, warmup=BENCHMARK_WARMUP_RUNS):
+    timings = []
+    async with get_http_client() as client:
+
+        async def run_checks(n):
+            for i in range(n):
+                start = time.perf_counter()
+                await check_rates_async(base_amount, client)
+                timings.append(time.perf_counter() - start)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Untimed: lazy imports and the first connections.
+            for i in range(warmup):
+                await check_rates_async(base_amount, client)
+            start = time.perf_counter()
+            async with trio.open_nursery() as nursery:
+                for i in range(concurrency):
+                    nursery.start_soon(run_checks, runs // concurrency)
+            elapsed = time.perf_counter() - start
+
+    return timings, elapsed
+
+def run_benchmarks(directory, runs=200, base_amount=100, concurrency=4, latency=0, error_rate=0):
+    snapshots = load_snapshots(directory)
+    if len(snapshots) == 0:
+        print("No snapshots found in " + directory)
+        return
+
+    x = prettytable.PrettyTable()
+    x.field_names = ["benchmark", "runs", "median ms", "p95 ms", "max ms", "checks/s"]
+
+    summary = get_timing_summary(benchmark_parse(snapshots, runs))
+    x.add_row(["parse", summary["runs"], round(summary["median_ms"], 3), round(summary["p95_ms"], 3), round(summary["max_ms"], 3), "-"])
+
+    server = start_replay(directory, latency, error_rate)
+    try:
+        for n in [1, concurrency]:
+            timings, elapsed = trio.run(benchmark_checks, base_amount, runs, n)
+            summary = get_timing_summary(timings)
+            x.add_row(["check x" + str(n), summary["runs"], round(summary["median_ms"], 3), round(summary["p95_ms"], 3), round(summary["max_ms"], 3), round(len(timings)/elapsed, 1)])
+    finally:
+        server.shutdown()
+        CONFIG["endpoints"] = None
+
+    x.align = "r"
+    print(x.get_string())
+
+#-------------------------------------------------------------------------------
+# Backtests: every snapshot in a directory (see save_snapshot) goes through the
+# parsers and the batch rate math, without fetching or printing tables.
+# Snapshot files are split into chunks handled by a process pool; each worker
+# returns only the best route per amount and the best rate per exchange.
+
+BACKTEST_CHUNK_SIZE = 64
+
+def init_backtest_worker(settings):
+    # Workers start from a fresh copy of the script: bring over what main()
+    # configured.
+    for key in ["base", "quote", "json_backend", "depth"]:
+        CONFIG[key] = settings[key]
+    for exchange, adapter in EXCHANGES.items():
+        adapter["enabled"] = exchange in settings["exchanges"]
+
+def backtest_snapshot_files(file_paths, amounts):
+    results = []
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            snapshot = load_json(f.read())
+        error_log = []
+        processed_rates = process_all_info(snapshot["responses"], error_log)
+        rates_matrix = get_rates_matrix(amounts, processed_rates)
+        # amounts x exchanges, with the best coin for each
+        exchange_rates = np.empty((len(amounts), 0))
+        if len(rates_matrix["coins"]) > 0:
+            exchange_rates = np.where(np.isnan(rates_matrix["rates"]), -np.inf, rates_matrix["rates"]).max(axis=1)
+        best_routes = []
+        for a, route in enumerate(get_best_routes(rates_matrix)):
+            if route is not None:
+                coin, exchange, rate = route
+                route = (coin, exchange, rate, float(rates_matrix["coins_transfered"][a, rates_matrix["coins"].index(coin)]))
+            best_routes.append(route)
+        results.append({
+            "timestamp": snapshot["timestamp"],
+            "best": best_routes,
+            "exchanges": rates_matrix["exchanges"],
+            "exchange_rates": exchange_rates.tolist(),
+            "errors": len(error_log)
+        })
+    return results
+
+def run_backtest(directory, amounts, workers=None):
+    file_paths = get_snapshot_files(directory)
+    if len(file_paths) == 0:
+        print("No snapshots found in " + directory, file=get_message_stream())
+        return
+    settings = {
+        "base": CONFIG["base"],
+        "quote": CONFIG["quote"],
+        "json_backend": CONFIG["json_backend"],
+        "depth": False,
+        "exchanges": [exchange for exchange, adapter in EXCHANGES.items() if adapter["enabled"]]
+    }
+    chunks = [file_paths[i:i+BACKTEST_CHUNK_SIZE] for i in range(0, len(file_paths), BACKTEST_CHUNK_SIZE)]
+
+    # best_counts[a][(coin, exchange)] = [snapshots, summed rate, first, last]
+    best_counts = [{} for amount in amounts]
+    # exchange_totals[a][exchange] = [snapshots, summed best rate, times best]
+    exchange_totals = [{} for amount in amounts]
+    snapshots = 0
+    snapshots_with_errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_backtest_worker, initargs=(settings,)) as executor:
+        for results in executor.map(backtest_snapshot_files, chunks, [amounts]*len(chunks)):
+            for result in results:
+                snapshots += 1
+                snapshots_with_errors += result["errors"] > 0
+                records = []
+                for a, route in enumerate(result["best"]):
+                    if route is None:
+                        continue
+                    coin, exchange, rate, coins_transfered = route
+                    counts = best_counts[a].setdefault((coin, exchange), [0, 0, result["timestamp"], None])
+                    counts[0] += 1
+                    counts[1] += rate
+                    counts[3] = result["timestamp"]
+                    totals = exchange_totals[a].setdefault(exchange, [0, 0, 0])
+                    totals[2] += 1
+                    records.append([result["timestamp"], CONFIG["base"], amounts[a], CONFIG["quote"], coin, exchange, coins_transfered, rate, False])
+                for a in range(len(amounts)):
+                    for exchange, rate in zip(result["exchanges"], result["exchange_rates"][a]):
+                        if math.isfinite(rate):
+                            totals = exchange_totals[a].setdefault(exchange, [0, 0, 0])
+                            totals[0] += 1
+                            totals[1] += rate
+                if CONFIG["output"] != "table":
+                    write_rate_records(records, CONFIG["output"])
+    elapsed = time.perf_counter() - start
+
+    if CONFIG["output"] != "table":
+        return
+    for a, amount in enumerate(amounts):
+        x = prettytable.PrettyTable()
+        x.field_names = ["coin", "exchange", "times best", "share %", "avg " + CONFIG["quote"] + "/" + CONFIG["base"], "first", "last"]
+        for (coin, exchange), counts in sorted(best_counts[a].items(), key=lambda item: -item[1][0]):
+            x.add_row([coin, exchange, counts[0], round(100*counts[0]/snapshots, 1), round(counts[1]/counts[0], 2), counts[2], counts[3]])
+        x.align = "r"
+        print("Best routes for " + str(amount) + " " + CONFIG["base"] + ":")
+        print(x.get_string())
+
+        x = prettytable.PrettyTable()
+        x.field_names = ["exchange", "snapshots", "avg best " + CONFIG["quote"] + "/" + CONFIG["base"], "times best"]
+        for exchange, totals in sorted(exchange_totals[a].items(), key=lambda item: -item[1][2]):
+            x.add_row([exchange, totals[0], round(totals[1]/totals[0], 2) if totals[0] > 0 else "-", totals[2]])
+        x.align = "r"
+        print(x.get_string())
+    print(str(snapshots) + " snapshots (" + str(snapshots_with_errors) + " with parse errors) in " + str(round(elapsed, 2)) + " s, " + str(round(snapshots/elapsed, 1)) + " snapshots/s")
+
+#-------------------------------------------------------------------------------
+
+def parse_deadlines(values):
+    deadlines = dict(EXCHANGE_DEADLINES)
+    default_deadline = DEFAULT_DEADLINE
+    for value in values or []:
+        if "=" in value:
+            exchange, seconds = value.rsplit("=", 1)
+            deadlines[exchange] = float(seconds)
+        else:
+            default_deadline = float(value)
+    return deadlines, default_deadline
+
+def get_cli_args():
+    parser = argparse.ArgumentParser(description="Compare fiat -> crypto -> fiat rates (EUR -> ARS by default) across exchanges.")
+    parser.add_argument("--no-session", action="store_true", help="open a new event loop and HTTP client for every check")
+    parser.add_argument("--max-connections", type=int, default=HTTP_MAX_CONNECTIONS)
+    parser.add_argument("--max-keepalive", type=int, default=HTTP_MAX_KEEPALIVE_CONNECTIONS)
+    parser.add_argument("--keepalive-expiry", type=float, default=HTTP_KEEPALIVE_EXPIRY, help="seconds an idle connection is kept open")
+    parser.add_argument("--base", type=str.upper, default=BASE_CURRENCY, help="currency spent on bit2me (default: EUR)")
+    parser.add_argument("--quote", type=str.upper, default=QUOTE_CURRENCY, help="currency received on the exchanges (default: ARS)")
+    parser.add_argument("--amounts", help="comma separated amounts of the base currency to evaluate in one batch")
+    parser.add_argument("--amounts-file", help="file with one amount of the base currency per line to evaluate in one batch")
+    parser.add_argument("--routes", metavar="AMOUNT", type=float, help="search the best multi-hop routes from the base to the quote currency for this amount")
+    parser.add_argument("--cross", metavar="CURRENCIES", nargs="?", const="", help="print the cross rates between comma separated currencies (default: the fiat and stablecoins quoted)")
+    parser.add_argument("--cross-hops", type=int, default=CROSS_MAX_HOPS, help="most trades per cross rate")
+    parser.add_argument("--top-k", type=int, default=ROUTES_TOP_K, help="number of routes shown by --routes")
+    parser.add_argument("--max-hops", type=int, default=ROUTES_MAX_HOPS, help="longest route considered by --routes")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="run the HTTP/JSON query service")
+    parser.add_argument("--refresh-interval", type=float, default=SERVICE_REFRESH_INTERVAL, help="seconds between background refreshes in --serve mode")
+    parser.add_argument("--watch", metavar="AMOUNT", type=float, help="keep polling the exchanges and redraw the rates for this amount as they change")
+    parser.add_argument("--watch-interval", action="append", metavar="[EXCHANGE=]SECONDS", help="polling interval, for all exchanges or for one (repeatable)")
+    parser.add_argument("--budget", type=float, default=LATENCY_BUDGET, help="seconds to wait for all exchanges before showing what has arrived")
+    parser.add_argument("--deadline", action="append", metavar="[EXCHANGE=]SECONDS", help="seconds each exchange, or one exchange, gets to answer (repeatable)")
+    parser.add_argument("--progressive", action="store_true", help="fill the table in as each exchange answers")
+    parser.add_argument("--store", metavar="DIR", help="append every processed set of rates to the time-series store in DIR")
+    parser.add_argument("--best", nargs=2, metavar=("COIN", "EXCHANGE"), help="print the best stored sell price (buy price for bit2me) and exit; needs --store")
+    parser.add_argument("--days", type=float, default=7, help="time range for --best, in days")
+    parser.add_argument("--enable", default="", metavar="EXCHANGES", help="comma separated exchanges to switch on (see exchanges.json)")
+    parser.add_argument("--disable", default="", metavar="EXCHANGES", help="comma separated exchanges to switch off")
+    parser.add_argument("--json-backend", choices=["auto", "orjson", "json"], default="auto", help="JSON parser for the exchange responses (auto: orjson if installed)")
+    parser.add_argument("--profile", action="store_true", help="print per-exchange latency, bytes and parse timings after every check")
+    parser.add_argument("--metrics-log", metavar="FILE", help="append the metrics of every check to FILE as JSON lines")
+    parser.add_argument("--metrics-prom", metavar="FILE", help="write the metrics of the last check to FILE in Prometheus text format")
+    parser.add_argument("--max-concurrency", type=int, default=FETCH_MAX_CONCURRENCY, help="requests in flight at once")
+    parser.add_argument("--host-rate", type=float, default=DEFAULT_HOST_RATE, help="requests per second allowed per host")
+    parser.add_argument("--host-burst", type=float, default=DEFAULT_HOST_BURST, help="burst size of the per-host rate limit")
+    parser.add_argument("--retries", type=int, default=FETCH_RETRIES, help="retries for failed, rate-limited or 5xx requests")
+    parser.add_argument("--depth", action="store_true", help="price sells against the order books of the exchanges that publish them")
+    parser.add_argument("--hedge", type=float, nargs="?", const=95, metavar="PERCENTILE", help="send a second request to exchanges slower than this percentile of their latency (default: 95)")
+    parser.add_argument("--hedge-ratio", type=float, default=HEDGE_MAX_RATIO, help="most extra requests hedging may add, as a fraction of all requests")
+    parser.add_argument("--alerts", metavar="FILE", help="JSON file with threshold alert rules, checked on every refresh")
+    parser.add_argument("--alert-sink", default="stderr", metavar="SINK[:TARGET]", help="where alerts go: stderr, file:PATH or webhook:URL")
+    parser.add_argument("--output", choices=["table", *RECORD_FORMATS], default="table", help="print a table, or stream one record per rate as JSON lines, CSV or Arrow IPC")
+    parser.add_argument("--no-warm-start", action="store_true", help="don't show or save the last known rates (" + WARM_START_FILE + ")")
+    parser.add_argument("--record", metavar="DIR", help="save the raw responses of every check to DIR")
+    parser.add_argument("--replay", metavar="DIR", help="serve the snapshots in DIR from a local stand-in server instead of the exchanges")
+    parser.add_argument("--replay-latency", type=float, default=0, help="seconds added to every replayed response")
+    parser.add_argument("--replay-error-rate", type=float, default=0, help="fraction of replayed responses that fail")
+    parser.add_argument("--benchmark", metavar="DIR", nargs="?", const="samples", help="run the offline benchmarks on the snapshots in DIR (default: samples)")
+    parser.add_argument("--benchmark-runs", type=int, default=200)
+    parser.add_argument("--backtest", metavar="DIR", help="replay every snapshot in DIR through the parsers and report the best routes over time for --amounts")
+    parser.add_argument("--backtest-workers", type=int, help="processes used by --backtest (default: one per CPU)")
+    return parser.parse_args()
 
 def main():
-    EUR_amount = get_user_input()
-    while isinstance(EUR_amount, float) == True:
-        check_rates(EUR_amount)
-        EUR_amount = get_user_input()
+    args = get_cli_args()
+    # Set first: it decides where messages go (see get_message_stream).
+    CONFIG["output"] = args.output
+    configure_exchanges(
+        [exchange.strip() for exchange in args.enable.split(",") if exchange.strip() != ""],
+        [exchange.strip() for exchange in args.disable.split(",") if exchange.strip() != ""]
+    )
+
+    if args.benchmark:
+        run_benchmarks(args.benchmark, args.benchmark_runs, latency=args.replay_latency, error_rate=args.replay_error_rate)
+        return
+
+    if args.best:
+        coin, exchange = args.best
+        print_best_stored_price(args.store or "store", coin.upper(), exchange, "buy" if exchange == BUY_EXCHANGE else "sell", args.days)
+        return
+
+    CONFIG["base"] = args.base
+    CONFIG["quote"] = args.quote
+    CONFIG["record_dir"] = args.record
+    CONFIG["json_backend"] = args.json_backend
+    CONFIG["profile"] = args.profile
+    CONFIG["max_concurrency"] = args.max_concurrency
+    CONFIG["host_rate"] = args.host_rate
+    CONFIG["host_burst"] = args.host_burst
+    CONFIG["retries"] = args.retries
+    CONFIG["depth"] = args.depth
+    CONFIG["hedge"] = args.hedge
+    CONFIG["hedge_ratio"] = args.hedge_ratio
+    sink, _, target = args.alert_sink.partition(":")
+    if has_key(ALERT_SINKS, sink) == False:
+        print("Unknown alert sink '" + sink + "'. Known sinks: " + ", ".join(ALERT_SINKS), file=get_message_stream())
+        return
+    CONFIG["alert_sink"] = (sink, target or None)
+    if args.alerts:
+        try:
+            print("Loaded " + str(load_alert_rules(args.alerts)) + " alert rules", file=sys.stderr)
+        except (OSError, ValueError) as e:
+            print("Could not load the alert rules in " + args.alerts + ": " + str(e), file=sys.stderr)
+            return
+    if args.output == "arrow" and importlib.util.find_spec("pyarrow") is None:
+        print("--output arrow needs the 'pyarrow' package", file=get_message_stream())
+        return
+    CONFIG["metrics_log"] = args.metrics_log
+    CONFIG["metrics_prom"] = args.metrics_prom
+    CONFIG["store_dir"] = args.store
+    CONFIG["budget"] = args.budget
+    CONFIG["deadlines"], CONFIG["default_deadline"] = parse_deadlines(args.deadline)
+    CONFIG["progressive"] = args.progressive
+    if args.backtest:
+        run_backtest(args.backtest, read_amounts(args.amounts, args.amounts_file) or [100], args.backtest_workers)
+        return
 
-    a = input("Fin. Apretá Enter para salir.")
+    if args.replay:
+        start_replay(args.replay, args.replay_latency, args.replay_error_rate)
+
+    if args.serve is not None:
+        host, port = "127.0.0.1", args.serve
+        if ":" in args.serve:
+            host, port = args.serve.rsplit(":", 1)
+        try:
+            trio.run(run_service, host, int(port), args.refresh_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.cross is not None:
+        currencies = [currency.strip().upper() for currency in args.cross.split(",") if currency.strip() != ""]
+        trio.run(print_cross_rates_async, currencies, args.cross_hops)
+        return
+
+    if args.routes is not None:
+        trio.run(find_routes_async, args.routes, args.top_k, args.max_hops)
+        return
+
+    if args.watch is not None:
+        if args.depth:
+            # Watch mode polls tickers only; it would silently price at the top of the book.
+            print("--depth is not supported with --watch")
+            return
+        intervals, default_interval = parse_watch_intervals(args.watch_interval)
+        try:
+            trio.run(run_watch, args.watch, intervals, default_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.amounts or args.amounts_file:
+        trio.run(sweep_amounts_async, read_amounts(args.amounts, args.amounts_file))
+        return
+
+    # Replayed rates are not the last known ones.
+    if args.no_warm_start == False and args.replay is None:
+        CONFIG["warm_start"] = WARM_START_FILE
+        warm = load_warm_start(WARM_START_FILE)
+        if warm is not None:
+            warm_start["quotes"], warm_start["timestamp"] = warm
+
+    if args.no_session:
+        base_amount = get_user_input()
+        while isinstance(base_amount, float) == True:
+            check_rates(base_amount)
+            base_amount = get_user_input()
+    else:
+        trio.run(run_session, args.max_connections, args.max_keepalive, args.keepalive_expiry)
+
+    a = read_line("Fin. Apretá Enter para salir.")
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        close_record_writers()
 
-main()
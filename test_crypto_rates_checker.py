@@ -0,0 +1,229 @@
+import importlib.util
+import json
+import math
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.join(HERE, "samples")
+
+
+@pytest.fixture(scope="module")
+def crc():
+    # The script has a hyphenated name, so it is loaded by path.
+    spec = importlib.util.spec_from_file_location("crypto_rates_checker", os.path.join(HERE, "crypto-rates-checker.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def sample_responses(crc):
+    snapshots = crc.load_snapshots(SAMPLES_DIR)
+    assert len(snapshots) > 0
+    return snapshots[0]["responses"]
+
+
+def process(crc, responses):
+    crc.parsed_quotes.clear()
+    crc.last_processed["sources"] = None
+    error_log = []
+    return crc.process_all_info(responses, error_log), error_log
+
+
+#-------------------------------------------------------------------------------
+# get_fill_price
+
+def test_fill_price_walks_the_book(crc):
+    book = crc.new_book([98, 100, 99], [1, 1, 1])
+    prices = crc.get_fill_price(book, [0.5, 1, 2, 2.5, 3])
+    np.testing.assert_allclose(prices, [100, 100, 99.5, (199 + 0.5*98)/2.5, 99])
+
+
+def test_fill_price_is_nan_beyond_a_thin_book(crc):
+    book = crc.new_book([100, 99], [1, 0.5])
+    prices = crc.get_fill_price(book, [1.5, 1.5000001, 10, 0])
+    assert prices[0] == pytest.approx((100 + 0.5*99)/1.5)
+    assert np.isnan(prices[1:]).all()
+
+
+#-------------------------------------------------------------------------------
+# find_routes
+
+def get_test_graph(crc):
+    graph = {}
+    crc.add_graph_edge(graph, "EUR", "BTC", "a", 0.5, 0.1)
+    crc.add_graph_edge(graph, "BTC", "ARS", "c", 100)
+    crc.add_graph_edge(graph, "EUR", "ETH", "b", 2)
+    crc.add_graph_edge(graph, "ETH", "ARS", "d", 24)
+    crc.add_graph_edge(graph, "EUR", "ARS", "e", 39)
+    return graph
+
+
+def test_find_routes_keeps_the_top_k(crc):
+    routes = crc.find_routes(get_test_graph(crc), 10, "EUR", "ARS", top_k=2)
+    assert [round(route["amount"], 6) for route in routes] == [490, 480]
+    assert routes[0]["steps"] == [("EUR", "BTC", "a"), ("BTC", "ARS", "c")]
+    assert routes[0]["rate"] == pytest.approx(49)
+
+
+def test_find_routes_charges_fees_per_amount(crc):
+    # The fixed network fee of the BTC route costs more on small amounts.
+    routes = crc.find_routes(get_test_graph(crc), 1, "EUR", "ARS", top_k=3)
+    assert [route["steps"][0][2] for route in routes] == ["b", "a", "e"]
+    assert routes[1]["amount"] == pytest.approx((0.5 - 0.1)*100)
+
+
+def test_find_routes_drops_routes_eaten_by_fees(crc):
+    routes = crc.find_routes(get_test_graph(crc), 0.1, "EUR", "ARS", top_k=5)
+    assert [route["steps"][0][2] for route in routes] == ["b", "e"]
+
+
+#-------------------------------------------------------------------------------
+# get_crossed_rules
+
+@pytest.fixture
+def alert_entry(crc, tmp_path):
+    rules = [
+        {"id": "up1", "coin": "btc", "exchange": "ripio", "amount": 100, "above": 100},
+        {"id": "up2", "coin": "btc", "exchange": "ripio", "amount": 100, "above": 110},
+        {"id": "down1", "coin": "btc", "exchange": "ripio", "amount": 100, "below": 90},
+        {"id": "down2", "coin": "btc", "exchange": "ripio", "amount": 100, "below": 80}
+    ]
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps(rules))
+    assert crc.load_alert_rules(str(path)) == 4
+    return crc.alert_rules["index"][("BTC", "ripio", 100.0)]
+
+
+def test_crossed_rules_on_the_first_refresh(crc, alert_entry):
+    assert crc.get_crossed_rules(alert_entry, None, 105) == [("above", 100.0, "up1")]
+    assert crc.get_crossed_rules(alert_entry, None, 85) == [("below", 90.0, "down1")]
+    assert crc.get_crossed_rules(alert_entry, None, 95) == []
+
+
+def test_crossed_rules_in_both_directions(crc, alert_entry):
+    assert crc.get_crossed_rules(alert_entry, 105, 115) == [("above", 110.0, "up2")]
+    assert crc.get_crossed_rules(alert_entry, 95, 75) == [("below", 80.0, "down2"), ("below", 90.0, "down1")]
+    assert crc.get_crossed_rules(alert_entry, 75, 95) == []
+    assert crc.get_crossed_rules(alert_entry, 115, 112) == []
+
+
+def test_invalid_alert_rules_are_reported(crc, tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps([{"coin": "btc", "exchange": "ripio", "amount": 1, "above": 1}, {"coin": "btc", "exchange": "ripio", "above": 1}]))
+    with pytest.raises(ValueError, match="alert rule 1 has no 'amount'"):
+        crc.load_alert_rules(str(path))
+
+
+#-------------------------------------------------------------------------------
+# query_store
+
+def test_query_store_selects_by_time_range(crc, sample_responses, tmp_path):
+    quotes, error_log = process(crc, sample_responses)
+    directory = str(tmp_path / "store")
+    times = [datetime(2020, 11, 5, 2, minute) for minute in [0, 10, 20]]
+    for timestamp in times:
+        crc.append_to_store(directory, quotes, timestamp)
+
+    records, names = crc.query_store(directory, coin="BTC", exchange="ripio", side="sell", start=times[1], end=times[1])
+    assert records["timestamp"].tolist() == [int(times[1].timestamp()*1000)]
+    records, names = crc.query_store(directory, coin="BTC", exchange="ripio", side="sell", start=times[1] + timedelta(seconds=1))
+    assert records["timestamp"].tolist() == [int(times[2].timestamp()*1000)]
+    records, names = crc.query_store(directory, coin="NOPE")
+    assert len(records["price"]) == 0
+
+
+def test_query_store_ignores_a_torn_append(crc, sample_responses, tmp_path):
+    quotes, error_log = process(crc, sample_responses)
+    directory = str(tmp_path / "store")
+    crc.append_to_store(directory, quotes, datetime(2020, 11, 5))
+    complete = len(crc.query_store(directory)[0]["price"])
+    # An append interrupted after writing only some columns.
+    with open(os.path.join(directory, "price.bin"), "ab") as f:
+        f.write(np.zeros(3, dtype=np.float64).tobytes())
+    records, names = crc.query_store(directory)
+    assert {len(values) for values in records.values()} == {complete}
+
+
+#-------------------------------------------------------------------------------
+# keep_warm_rates
+
+def test_keep_warm_rates_fills_silent_exchanges(crc, sample_responses):
+    warm_quotes, error_log = process(crc, sample_responses)
+    fresh, error_log = process(crc, {name: raw for name, raw in sample_responses.items() if name != "ripio"})
+    warm_time = datetime(2020, 11, 5, 2, 23)
+    stale = {}
+    missing = ["ripio", "argenbtc"]
+
+    kept = crc.keep_warm_rates(fresh, (warm_quotes, warm_time), stale, missing)
+
+    assert stale == {"ripio": warm_time}
+    assert missing == ["argenbtc"]
+    r = kept["exchange_index"]["ripio"]
+    for coin in ["BTC", "ETH"]:
+        assert kept["sell"][kept["coin_index"][coin], r] == warm_quotes["sell"][warm_quotes["coin_index"][coin], warm_quotes["exchange_index"]["ripio"]]
+    # Exchanges that answered keep their fresh quotes.
+    s = kept["exchange_index"]["sat. t."]
+    assert kept["sell"][kept["coin_index"]["BTC"], s] == fresh["sell"][fresh["coin_index"]["BTC"], fresh["exchange_index"]["sat. t."]]
+
+
+def test_keep_warm_rates_fills_missing_buys(crc, sample_responses):
+    warm_quotes, error_log = process(crc, sample_responses)
+    fresh, error_log = process(crc, {name: raw for name, raw in sample_responses.items() if name != "bit2me_new"})
+    stale = {}
+    missing = ["bit2me_new#1"]
+
+    kept = crc.keep_warm_rates(fresh, (warm_quotes, datetime(2020, 11, 5)), stale, missing)
+
+    assert list(stale) == ["bit2me_new#1"] and missing == []
+    c = kept["coin_index"]["BTC"]
+    assert kept["has_buy"][c] and kept["buy"][c] == warm_quotes["buy"][warm_quotes["coin_index"]["BTC"]]
+
+
+def test_keep_warm_rates_without_missing_exchanges(crc, sample_responses):
+    quotes, error_log = process(crc, sample_responses)
+    assert crc.keep_warm_rates(quotes, (quotes, datetime(2020, 11, 5)), {}, []) is quotes
+
+
+#-------------------------------------------------------------------------------
+# process_info_bit2me_new
+
+def test_bit2me_chunks_match_their_currencies(crc):
+    quotes = crc.new_quotes()
+    error_log = []
+    crc.process_info_bit2me_new({
+        "bit2me_new:1:BTC,ETH": b"[10, 2]",
+        "bit2me_new:2:LTC,DAI": b'{"DAI": 1.5, "LTC": null}'
+    }, quotes, error_log)
+    assert error_log == []
+    buys = {coin: quotes["buy"][c] for c, coin in enumerate(quotes["coins"]) if quotes["has_buy"][c]}
+    assert buys == {"BTC": 10, "ETH": 2, "DAI": 1.5}
+
+
+def test_bit2me_chunk_with_the_wrong_length_is_ignored(crc):
+    quotes = crc.new_quotes()
+    error_log = []
+    crc.process_info_bit2me_new({"bit2me_new:1:BTC,ETH,XRP": b"[1, 2]"}, quotes, error_log)
+    assert len(quotes["coins"]) == 0
+    assert error_log == ["bit2me_new sent 2 prices for 3 currencies, ignoring them"]
+
+
+def test_bit2me_chunk_names(crc):
+    assert crc.get_bit2me_chunk_currencies("bit2me_new:3:BTC,ETH") == ["BTC", "ETH"]
+    # Snapshots recorded before chunk numbers, and before chunking.
+    assert crc.get_bit2me_chunk_currencies("bit2me_new:BTC,ETH") == ["BTC", "ETH"]
+    assert crc.get_bit2me_chunk_currencies("bit2me_new") == crc.bit2me_currencies
+    assert crc.get_endpoint_label("bit2me_new:3:BTC,ETH") == "bit2me_new#3"
+    assert crc.get_endpoint_exchange("bit2me_new:3:BTC,ETH") == "bit2me_new"
+
+
+def test_sample_snapshot_parses(crc, sample_responses):
+    quotes, error_log = process(crc, sample_responses)
+    assert error_log == []
+    rates_matrix = crc.get_rates_matrix([1000], quotes)
+    assert "BTC" in rates_matrix["coins"] and "ripio" in rates_matrix["exchanges"]
+    assert math.isfinite(np.nanmax(rates_matrix["rates"]))